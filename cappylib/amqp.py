@@ -33,7 +33,8 @@
 # IMPORTS 
 ##############################################################################################
 
-import pika, logging
+import pika, logging, os, re, socket, thread, threading, time, json, marshal, zlib
+import multiprocessing, Queue, mmap, struct, glob, uuid, sys
 from cappylib.general import *
 
 ##############################################################################################
@@ -44,11 +45,321 @@ from cappylib.general import *
 # MAIN CODE
 ##############################################################################################
 
+# AmqpCodec - message codec tagged by content type
+class AmqpCodec(object):
+    """message codec tagged by content type; encode maps a message to a str or buffer body 
+       and decode maps a received body back to a message"""
+
+    def __init__(self, contentType, encode, decode):
+        """set content type and encode/decode functions"""
+
+        self.contentType = contentType
+        self.encode = encode
+        self.decode = decode
+
+# amqpView - returns bytes-like data as a str or zero-copy buffer that pika can frame
+def amqpView(data):
+    """
+    returns bytes-like data as a str or read-only buffer without copying where possible; 
+    bytearrays are wrapped in a buffer, memoryviews are copied since pika cannot slice 
+    them into frames
+    """
+
+    if isinstance(data, memoryview): return data.tobytes()
+    if isinstance(data, bytearray): return buffer(data)
+    return data
+
+# amqpCodecs - built-in codecs by name; add AmqpCodec objects to register new codecs
+amqpCodecs = {
+    'raw': AmqpCodec('application/octet-stream', amqpView, lambda body: body),
+    'json': AmqpCodec('application/json', lambda m: json.dumps(m, separators=(',', ':')),
+                      json.loads),
+    'marshal': AmqpCodec('application/x-marshal', marshal.dumps, marshal.loads)
+    }
+
+# amqpEncode - encodes a message, compressing large bodies, and returns (body, properties)
+def amqpEncode(codec, message, compress=None, level=1):
+    """encodes message with the named codec, deflates bodies of at least compress bytes 
+       (if set) using zlib level, and returns (body, properties) tagged with content type 
+       and encoding"""
+
+    c = amqpCodecs[codec]
+    body = amqpView(c.encode(message))
+    encoding = None
+    if compress is not None and len(body) >= compress:
+        (body, encoding) = (zlib.compress(body, level), 'deflate')
+
+    return (body, pika.BasicProperties(content_type=c.contentType, content_encoding=encoding))
+
+# amqpDecode - decompresses and decodes a body using its properties
+def amqpDecode(body, properties):
+    """decompresses and decodes body using the content encoding and type in properties; 
+       bodies with no properties or an unknown content type are returned as received"""
+
+    if body is None or properties is None: return body
+    if properties.content_encoding == 'deflate': body = zlib.decompress(body)
+    for c in amqpCodecs.values():
+        if c.contentType == properties.content_type: return c.decode(body)
+
+    return body
+
+# AmqpTopology - process-wide cache of exchange and queue declarations
+class AmqpTopology(object):
+    """
+    process-wide cache of exchange and queue declarations keyed by broker, kind, name, and
+    declaration arguments so Amqp objects skip redundant declare round trips (exclusive 
+    and auto_delete declarations can vanish and are not cached); entries older than ttl 
+    secs (if set) are declared again, and all entries for a broker are dropped when one of
+    its channels or connections closes unexpectedly
+    """
+
+    # constructor method - set ttl and initialize the cache
+    def __init__(self, ttl=None):
+        """set entry ttl in secs (None never expires) and initialize the cache"""
+
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.brokers = dict()  # broker -> dict((kind, name, args) -> declared time)
+
+    # cached method - checks if a declaration is cached and fresh
+    def cached(self, broker, kind, name, args):
+        """returns True if the declaration is cached and younger than ttl"""
+
+        with self.lock:
+            t = self.brokers.get(broker, dict()).get((kind, name, repr(sorted(args.items()))))
+        return t is not None and (self.ttl is None or time.time() - t < self.ttl)
+
+    # add method - caches a declaration
+    def add(self, broker, kind, name, args):
+        """caches a declaration as of now"""
+
+        with self.lock:
+            entries = self.brokers.setdefault(broker, dict())
+            entries[(kind, name, repr(sorted(args.items())))] = time.time()
+
+    # remove method - drops all declarations of kind and name (e.g. after a delete)
+    def remove(self, broker, kind, name):
+        """drops all cached declarations of kind and name for broker"""
+
+        with self.lock:
+            entries = self.brokers.get(broker, dict())
+            for k in entries.keys():
+                if k[:2] == (kind, name): del entries[k]
+
+    # names method - returns the names of cached declarations of kind
+    def names(self, broker, kind):
+        """returns the sorted names of cached declarations of kind for broker"""
+
+        with self.lock:
+            return sorted(set([k[1] for k in self.brokers.get(broker, dict()) if k[0] == kind]))
+
+    # invalidate method - drops all declarations for a broker
+    def invalidate(self, broker):
+        """drops all cached declarations for broker"""
+
+        with self.lock:
+            self.brokers.pop(broker, None)
+
+# amqpTopology - process-wide declaration cache shared by all Amqp objects
+amqpTopology = AmqpTopology()
+
+# AmqpPool - process-wide pool of long-lived amqp connections and channels
+class AmqpPool(object):
+    """
+    pool of long-lived amqp connections and channels keyed by connection params; connections
+    are health-checked before reuse, reconnected on demand, and limited to maxChannels open
+    channels each; pika connections are not thread-safe, so each thread gets its own
+    connections, and those of threads that have exited are closed when another thread 
+    first uses the pool; after os.fork() the inherited connections are dropped (not closed)
+    """
+
+    # constructor method - set limits and initialize pool state
+    def __init__(self, maxChannels=64, maxConnections=8):
+        """set per-connection channel and per-key connection limits and initialize pool"""
+
+        self.maxChannels = maxChannels
+        self.maxConnections = maxConnections
+        self.lock = threading.Lock()
+        self.reset()
+
+    # reset method - drops all pooled connections without closing them
+    def reset(self):
+        """drops all pooled connections without closing them (e.g. sockets owned by parent)"""
+
+        self.pid = os.getpid()
+        self.pools = dict()  # (key, thread id) -> list of dicts(conn, idle, count)
+
+    # alive method - checks if a pooled connection is healthy
+    @staticmethod
+    def alive(conn):
+        """returns True if conn is open and processes pending I/O without error"""
+
+        try:
+            if conn is None or not conn.is_open: return False
+            conn.process_data_events()
+            return conn.is_open
+        except (pika.exceptions.AMQPError, socket.error):
+            return False
+
+    # discard method - closes a connection, ignoring errors
+    @staticmethod
+    def discard(conn):
+        """closes conn, ignoring errors"""
+
+        try:
+            if conn.is_open: conn.close()
+        except (pika.exceptions.AMQPError, socket.error):
+            pass
+
+    # entries method - returns the list of pooled connections for key in this process/thread
+    def entries(self, key):
+        """returns the list of pooled connections for key in the current process and thread,
+           closing the connections of exited threads when a thread first uses key"""
+
+        threading.current_thread()  # registers threads not started by threading
+        with self.lock:
+            if self.pid != os.getpid(): self.reset()
+            k = (key, thread.get_ident())
+            if k not in self.pools:
+                alive = set([t.ident for t in threading.enumerate()])
+                for dead in [p for p in self.pools if p[1] not in alive]:
+                    for e in self.pools.pop(dead): AmqpPool.discard(e['conn'])
+            return self.pools.setdefault(k, list())
+
+    # acquire method - returns a healthy (conn, channel) pair for key
+    def acquire(self, key, connect):
+        """
+        returns a healthy (conn, channel) pair for key, reusing idle channels first, then
+        opening channels on connections with spare capacity, then opening new connections;
+        connect is called with no args and must return a new BlockingConnection
+        """
+
+        entries = self.entries(key)
+
+        # drop dead connections so they are reconnected below
+        for e in list(entries):
+            if not AmqpPool.alive(e['conn']):
+                entries.remove(e)
+                amqpTopology.invalidate(key)
+
+        # reuse an idle channel on a healthy connection
+        for e in entries:
+            while e['idle']:
+                channel = e['idle'].pop()
+                if channel.is_open: return (e['conn'], channel)
+                # a channel closed by the broker may mean declarations were lost
+                e['count'] -= 1
+                amqpTopology.invalidate(key)
+
+        # open a new channel on a connection with spare channel capacity
+        for e in entries:
+            if e['count'] < self.maxChannels:
+                e['count'] += 1
+                return (e['conn'], e['conn'].channel())
+
+        # open a new connection, if allowed
+        if len(entries) >= self.maxConnections:
+            raise error('AmqpPool.acquire', 'error', 'connection and channel limits reached')
+        conn = connect()
+        entries.append({'conn': conn, 'idle': list(), 'count': 1})
+
+        return (conn, conn.channel())
+
+    # release method - returns a channel to the pool
+    def release(self, key, conn, channel):
+        """
+        returns channel to the pool for reuse; closed channels and connections are dropped
+        and invalidate cached declarations; pass channel=None to discard a channel that was
+        closed as expected
+        """
+
+        for e in self.entries(key):
+            if e['conn'] is conn:
+                if not conn.is_open:
+                    self.entries(key).remove(e)
+                    amqpTopology.invalidate(key)
+                elif channel is not None and channel.is_open:
+                    e['idle'].append(channel)
+                else:
+                    e['count'] -= 1
+                    if channel is not None: amqpTopology.invalidate(key)
+                return
+
+# amqpPool - process-wide connection pool used by non-persistent Amqp objects
+amqpPool = AmqpPool()
+
+# AmqpConfirms - publisher-confirm channel with a window of unconfirmed messages in flight
+class AmqpConfirms(object):
+    """
+    publisher-confirm channel allowing up to window unconfirmed messages in flight; pika's
+    BlockingChannel waits for every confirm, so messages are published on its underlying
+    asynchronous channel and confirms are pumped through the blocking connection
+    """
+
+    # constructor method - open a channel on conn and put it in confirm mode
+    def __init__(self, conn, window=1000, timeout=30):
+        """open a channel on blocking connection conn and put it in confirm mode"""
+
+        self.conn = conn
+        self.window = window
+        self.timeout = timeout
+        self.channel = conn.channel()
+        self.channel._impl.confirm_delivery(self.onConfirm)
+        self.tag = 0             # last delivery tag published
+        self.pending = dict()    # delivery tag -> message
+        self.nacked = list()     # nacked or unconfirmed messages
+
+    # onConfirm method - handles Basic.Ack and Basic.Nack frames from the broker
+    def onConfirm(self, frame):
+        """removes confirmed messages from pending, saving nacked messages"""
+
+        tag = frame.method.delivery_tag
+        nack = isinstance(frame.method, pika.spec.Basic.Nack)
+        tags = [t for t in self.pending if t <= tag] if frame.method.multiple else [tag]
+        for t in sorted(tags):
+            message = self.pending.pop(t, None)
+            if nack and message is not None: self.nacked.append(message)
+
+    # publish method - publishes a message once the window has room
+    def publish(self, exchange, key, body, message=None, properties=None):
+        """publishes body once fewer than window messages are unconfirmed; message is what 
+           is reported back if the broker nacks the delivery (defaults to body)"""
+
+        if len(self.pending) >= self.window: self.wait(self.window - 1)
+        self.tag += 1
+        self.pending[self.tag] = body if message is None else message
+        self.channel._impl.basic_publish(exchange, key, body, properties)
+
+    # wait method - pumps confirms until no more than limit messages are unconfirmed
+    def wait(self, limit=0):
+        """pumps confirms until no more than limit messages are unconfirmed; messages still
+           unconfirmed after timeout secs or on channel close are treated as nacked"""
+
+        deadline = time.time() + self.timeout
+        while len(self.pending) > limit:
+            if time.time() > deadline or not self.channel.is_open:
+                self.nacked.extend([self.pending[t] for t in sorted(self.pending)])
+                self.pending.clear()
+                break
+            self.conn.process_data_events(time_limit=0.01)
+
+    # close method - closes the confirm channel
+    def close(self):
+        """closes the confirm channel"""
+
+        if self.channel.is_open: self.channel.close()
+
 # amqp class - amqp connection and interface
 class Amqp:
 
     # data attributes
     persistent = False  # connection persistence
+    pooled = True       # use amqpPool when not persistent
+    key = None          # pool key
+    codec = None        # name of message codec in amqpCodecs (None sends raw strings)
+    compress = None     # deflate bodies of at least this many bytes (None disables)
+    spool = None        # amqp config with a 'spool' path; publish spools to amqpSpool(spool)
+    confirms = None     # publisher-confirm channel (AmqpConfirms)
     username = ''
     password = ''
     params = None
@@ -66,27 +377,59 @@ class Amqp:
         self.queues = dict()
 
         # separate out amqp parameters from credentials
-        excludeKeys = ['username','password','persistent']
+        excludeKeys = ['username','password','persistent','pooled','codec','compress','spool']
         self.params = dict(filter(lambda (k, v): k not in excludeKeys, amqp.items()))
         self.persistent = False if 'persistent' not in amqp.keys() else amqp['persistent']
+        self.pooled = True if 'pooled' not in amqp.keys() else amqp['pooled']
         self.username = 'guest' if 'username' not in amqp.keys() else amqp['username']
         self.password = 'guest' if 'password' not in amqp.keys() else amqp['password']
+        self.codec = None if 'codec' not in amqp.keys() else amqp['codec']
+        self.compress = None if 'compress' not in amqp.keys() else amqp['compress']
+        self.spool = None if 'spool' not in amqp.keys() else amqp
+        if self.spool is not None: amqpSpool(amqp)  # start replaying orphaned segments
+        self.key = repr((self.username, self.password, sorted(self.params.items())))
 
         # create logging handler for pika warnings
         logging.basicConfig()
 
     # connect method - connects to amqp server
     def connect(self):
-        """connects to amqp server using internal credentials, params, and conn object"""
+        """
+        connects to amqp server using internal credentials, params, and conn object; 
+        non-persistent objects check out a connection and channel from amqpPool unless 
+        'pooled' is False
+        """
 
         try:
-            c = pika.PlainCredentials(self.username, self.password)
-            p = pika.ConnectionParameters(credentials=c, **self.params)
-            self.conn = pika.BlockingConnection(p)
-            self.channel = self.conn.channel()
-        except pika.exceptions as e:
+            if self.pooled and not self.persistent:
+                (self.conn, self.channel) = amqpPool.acquire(self.key, self._Amqp__open)
+            else:
+                self.conn = self._Amqp__open()
+                self.channel = self.conn.channel()
+        except pika.exceptions.AMQPError as e:
             raise error('Amqp.connect', 'error', ' '.join([str(a) for a in e.args]))
 
+    # __open method - opens a new blocking connection (private)
+    def __open(self):
+        """opens a new blocking connection using internal credentials and params"""
+
+        c = pika.PlainCredentials(self.username, self.password)
+        p = pika.ConnectionParameters(credentials=c, **self.params)
+        return pika.BlockingConnection(p)
+
+    # encode method - encodes a message with the codec, if any
+    def encode(self, message):
+        """returns (body, properties) for message using the codec and compress settings"""
+
+        if self.codec is None: return (message, None)
+        return amqpEncode(self.codec, message, self.compress)
+
+    # decode method - decodes a received body with the codec, if any
+    def decode(self, body, properties):
+        """returns the message for a received body if a codec is set, otherwise the body"""
+
+        return body if self.codec is None else amqpDecode(body, properties)
+
     # exDeclare method - declares an exchange
     def exDeclare(self, exName, exParams):
         """declares an exchange"""
@@ -102,7 +445,12 @@ class Amqp:
         try:
             # declare and save the exchange, if not already declared and saved
             if exName not in self.exchanges.keys():
-                self.channel.exchange_declare(exchange=exName, **exParams)
+                # auto_delete exchanges can vanish at any time and are never shared
+                shared = not exParams.get('auto_delete', False)
+                if not (shared and 
+                        amqpTopology.cached(self.key, 'exchange', exName, exParams)):
+                    self.channel.exchange_declare(exchange=exName, **exParams)
+                    if shared: amqpTopology.add(self.key, 'exchange', exName, exParams)
                 self.exchanges[exName] = exParams
         except pika.exceptions as e:
             raise error('Amqp.exDeclare', 'error', ' '.join([str(a) for a in e.args]))
@@ -122,18 +470,39 @@ class Amqp:
         try:
             # declare, bind, and save the queue, if not already declared, bound, and saved
             if qName not in self.queues.keys():
-                self.channel.queue_declare(queue=qName, **qParams)
-                self.channel.queue_bind(queue=qName, exchange=exName, routing_key=key)
-                self.queues[qName] = dict(qParams.items() + [('exchange', exName),
-                                                             ('routing_key', key)])
+                q = dict(qParams.items() + [('exchange', exName), ('routing_key', key)])
+                # exclusive queues belong to a single connection and auto_delete queues can 
+                # vanish at any time, so neither is shared
+                shared = not (qParams.get('exclusive', False) or 
+                              qParams.get('auto_delete', False))
+                if not (shared and amqpTopology.cached(self.key, 'queue', qName, q)):
+                    self.channel.queue_declare(queue=qName, **qParams)
+                    self.channel.queue_bind(queue=qName, exchange=exName, routing_key=key)
+                    if shared: amqpTopology.add(self.key, 'queue', qName, q)
+                self.queues[qName] = q
         except pika.exceptions as e:
             raise error('Amqp.qDeclare', 'error', ' '.join([str(a) for a in e.args]))
 
     # publish method - declares an exchange and publishes a message
     def publish(self, exchange, message='', key=''):
-        """declares an exchange and publishes a message"""
+        """
+        declares an exchange and publishes a message; if a spool is set, messages are 
+        written to the spool when the broker is unreachable and while spooled messages 
+        are still being replayed (to keep message order)
+        """
 
-        if self.conn is None or self.conn.is_closed: self.connect()
+        # spool the message while spooled messages are being replayed (the spool is looked
+        # up per process, so a forked child never writes its parent's segments)
+        spool = None if self.spool is None else amqpSpool(self.spool)
+        if spool is not None and spool.count:
+            return spool.append(exchange, key, message)
+
+        try:
+            if self.conn is None or self.conn.is_closed: self.connect()
+        except error:
+            # broker is unreachable; spool the message, if enabled
+            if spool is None: raise
+            return spool.append(exchange, key, message)
 
         # separate out exchange parameters
         exParams = dict(filter(lambda (k, v): k not in ['exchange'], exchange.items()))
@@ -141,14 +510,57 @@ class Amqp:
         try:
             # declare the exchange and publish the message
             self._Amqp__exDeclare(exchange['exchange'], exParams)
+            (body, properties) = self.encode(message)
             self.channel.basic_publish(exchange=exchange['exchange'], 
                                        routing_key=key, 
-                                       body=message)
+                                       body=body,
+                                       properties=properties)
+        except (pika.exceptions.AMQPConnectionError, socket.error):
+            # connection was lost; drop it and spool the message, if enabled
+            if spool is None: raise
+            (self.conn, self.channel) = (None, None)
+            return spool.append(exchange, key, message)
         except pika.exceptions as e:
             raise error('Amqp.publish', 'error', ' '.join([str(a) for a in e.args]))
 
         if not self.persistent: self.close()
 
+    # publishBatch method - declares exchanges and publishes many messages with confirms
+    def publishBatch(self, messages, window=1000, timeout=30):
+        """
+        declares exchanges and publishes an iterable of (exchange, key, message) tuples using
+        publisher confirms with up to window unconfirmed messages in flight; returns a list 
+        of the (exchange, key, message) tuples nacked or not confirmed within timeout secs
+        """
+
+        if self.conn is None or self.conn.is_closed: self.connect()
+
+        try:
+            # open (or reuse) the confirm channel
+            if self.confirms is None or not self.confirms.channel.is_open:
+                self.confirms = AmqpConfirms(self.conn, window, timeout)
+            (self.confirms.window, self.confirms.timeout) = (window, timeout)
+
+            # declare each new exchange and publish the messages
+            for (exchange, key, message) in messages:
+                if exchange['exchange'] not in self.exchanges:
+                    exParams = dict(filter(lambda (k, v): k not in ['exchange'], 
+                                           exchange.items()))
+                    self._Amqp__exDeclare(exchange['exchange'], exParams)
+                (body, properties) = self.encode(message)
+                self.confirms.publish(exchange['exchange'], key, body, 
+                                      (exchange, key, message), properties)
+
+            # wait for all outstanding confirms and collect nacked messages
+            self.confirms.wait()
+            (nacked, self.confirms.nacked) = (self.confirms.nacked, list())
+        except pika.exceptions.AMQPError as e:
+            raise error('Amqp.publishBatch', 'error', ' '.join([str(a) for a in e.args]))
+
+        if not self.persistent: self.close()
+
+        return nacked
+
     # consume method - declares an exchange and queue and returns a single message
     #                  NOTE: no_ack when True tells the broker to not expect a reply
     def consume(self, exchange, queue, key=None, no_ack=True):
@@ -166,13 +578,44 @@ class Amqp:
             self._Amqp__qDeclare(queue['queue'], exchange['exchange'], qParams, key)
             (frame, header, body) = self.channel.basic_get(queue=queue['queue'], 
                                                            no_ack=no_ack)
-            # return the message body
-            return body
+
+            # an unacked message can no longer be acked once the channel is released, so 
+            # close the channel (requeueing the message) rather than pooling it
+            if not self.persistent and not no_ack and frame is not None:
+                self.channel.close()
+                self.channel = None
         except pika.exceptions as e:
             raise error('Amqp.consume', 'error', ' '.join([str(a) for a in e.args]))
 
         if not self.persistent: self.close()
 
+        # return the (decoded) message body
+        return self.decode(body, header)
+
+    # stream method - declares an exchange and queue and returns a streaming consumer
+    def stream(self, exchange, queue, key=None, **settings):
+        """
+        declares an exchange and queue like consume and returns an AmqpConsumer that pushes
+        messages from the queue; settings are passed to AmqpConsumer (prefetch, ackEvery, 
+        ackInterval, inactivity, no_ack, properties); the connection is held until the consumer is 
+        cancelled
+        """
+
+        if self.conn is None or self.conn.is_closed: self.connect()
+
+        # separate out exchange & queue parameters
+        exParams = dict(filter(lambda (k, v): k not in ['exchange'], exchange.items()))
+        qParams = dict(filter(lambda (k, v): k not in ['queue'], queue.items()))
+
+        try:
+            # declare the exchange, declare and bind the queue
+            self._Amqp__exDeclare(exchange['exchange'], exParams)
+            self._Amqp__qDeclare(queue['queue'], exchange['exchange'], qParams, key)
+        except pika.exceptions.AMQPError as e:
+            raise error('Amqp.stream', 'error', ' '.join([str(a) for a in e.args]))
+
+        return AmqpConsumer(self, queue['queue'], **settings)
+
     # qStatus method - checks the status of a queue and returns a tuple (exists, msgCount)
     def qStatus(self, qName):
         """checks the status of a queue and returns message count"""
@@ -188,11 +631,87 @@ class Amqp:
         except pika.exceptions.ChannelClosed as e:
             # if error is other than 404 (queue doesn't exist), re-raise
             if len(e.args) and e.args[0] != 404: raise
+            # the 404 closed the channel as expected; discard it (persistent objects reopen)
+            self.channel = self.conn.channel() if self.persistent else None
 
         if not self.persistent: self.close()
 
         return result
 
+    # qStatusMany method - checks the status of many queues and returns a dict of tuples
+    def qStatusMany(self, qNames=None, pattern=None, channels=16, timeout=10):
+        """
+        checks the status of many queues over one connection and returns a dict of qName: 
+        (exists, msgCount, consumerCount); qNames defaults to the queues declared through 
+        this process and pattern (a regex) filters the names; pika sends one synchronous 
+        method at a time per channel, so passive declares are spread over up to channels 
+        dedicated channels with one in flight on each; a 404 closes a channel, so the queue
+        it was declaring is marked as missing and the channel is replaced
+        """
+
+        names = list(qNames) if qNames is not None else \
+            sorted(set(self.queues.keys() + amqpTopology.names(self.key, 'queue')))
+        if pattern is not None: names = [n for n in names if re.search(pattern, n)]
+        (result, pos) = (dict(), [0])
+
+        if self.conn is None or self.conn.is_closed: self.connect()
+
+        # open a dedicated channel for lane, recording why it closes
+        def open(lane):
+            closed = list()
+            lane.update(channel=self.conn.channel(), name=None, closed=closed)
+            lane['channel']._impl.add_on_close_callback(lambda ch, code, text: 
+                                                        closed.append((code, text)))
+            return lane
+
+        # send the next passive declare on lane's channel, if any names are left
+        def send(lane):
+            if pos[0] >= len(names): 
+                lane['name'] = None
+                return
+            (lane['name'], pos[0]) = (names[pos[0]], pos[0] + 1)
+            lane['channel']._impl.queue_declare(onDeclare(lane), queue=lane['name'], 
+                                                passive=True)
+
+        def onDeclare(lane):
+            def callback(frame):
+                m = frame.method
+                result[lane['name']] = (True, m.message_count, m.consumer_count)
+                send(lane)
+            return callback
+
+        lanes = list()
+        try:
+            for i in range(min(channels, len(names))): lanes.append(open(dict()))
+            for lane in lanes: send(lane)
+
+            # pump replies until every lane is idle, replacing channels closed by a 404
+            deadline = time.time() + timeout
+            while [lane for lane in lanes if lane['name'] is not None]:
+                if time.time() > deadline:
+                    raise error('Amqp.qStatusMany', 'error', 'timeout')
+                self.conn.process_data_events(time_limit=0.01)
+                for lane in lanes:
+                    if lane['name'] is None or lane['channel'].is_open: continue
+                    if not lane['closed'] or lane['closed'][0][0] != 404:
+                        raise error('Amqp.qStatusMany', 'error', 
+                                    *[str(c) for c in (lane['closed'] or [('closed',)])[0]])
+                    result[lane['name']] = (False, 0, 0)
+                    send(open(lane))
+        except pika.exceptions.AMQPError as e:
+            raise error('Amqp.qStatusMany', 'error', ' '.join([str(a) for a in e.args]))
+
+        # close the lane channels and release the connection, even after a timeout or error
+        finally:
+            for lane in lanes:
+                try:
+                    if lane['channel'].is_open: lane['channel'].close()
+                except (pika.exceptions.AMQPError, socket.error):
+                    pass
+            if not self.persistent: self.close()
+
+        return result
+
     # qDelete method - unbinds, purges, and deletes one or all queues
     def qDelete(self, qName=None):
         """unbinds, purges, and deletes one or all queues"""
@@ -209,6 +728,7 @@ class Amqp:
                     self.channel.queue_purge(queue=q, nowait=False)
                     self.channel.queue_delete(queue=q, if_unused=False, if_empty=False, 
                                               nowait=False)
+                    amqpTopology.remove(self.key, 'queue', q)
                     del self.queues[q]
         except pika.exceptions as e:
             raise error('Amqp.qDelete', 'error', ' '.join([str(a) for a in e.args]))
@@ -226,6 +746,7 @@ class Amqp:
             for ex in self.exchanges.keys():
                 if exName == None or ex == exName:
                     self.channel.exchange_delete(exchange=ex, if_unused=False, nowait=False)
+                    amqpTopology.remove(self.key, 'exchange', ex)
                     del self.exchanges[ex]
         except pika.exceptions as e:
             raise error('Amqp.exDelete', 'error', ' '.join([str(a) for a in e.args]))
@@ -241,13 +762,1152 @@ class Amqp:
             self.exDelete()
 
         try:
-            if self.channel and self.channel.is_open: self.channel.close()
-            if self.conn and self.conn.is_open: self.conn.close()
+            # close the confirm channel, if any
+            if self.confirms is not None: self.confirms.close()
+            self.confirms = None
+            # return pooled connections and channels to the pool instead of closing them
+            if self.pooled and not self.persistent and self.conn is not None:
+                amqpPool.release(self.key, self.conn, self.channel)
+            else:
+                # a channel closed by the broker may mean declarations were lost
+                if self.channel is not None and not self.channel.is_open:
+                    amqpTopology.invalidate(self.key)
+                if self.channel and self.channel.is_open: self.channel.close()
+                if self.conn and self.conn.is_open: self.conn.close()
             self.channel = None
             self.conn = None
         except pika.exceptions as e:
             raise error('Amqp.close', 'error', ' '.join([str(a) for a in e.args]))
 
+# AmqpMonitor - cached status of many queues, optionally polled in the background
+class AmqpMonitor(object):
+    """
+    status of many queues from Amqp.qStatusMany cached for ttl secs; status() refreshes a
+    stale cache on the calling thread, or, with background=True, a daemon thread refreshes
+    the cache every ttl secs on its own pooled connection and status() never blocks
+    """
+
+    # constructor method - set queues and ttl and start polling, if background
+    def __init__(self, amqp, qNames=None, pattern=None, ttl=5, background=False):
+        """set queues (qNames and/or pattern, see Amqp.qStatusMany) and ttl using amqp 
+           config and start the background thread, if background"""
+
+        self.amqp = amqp
+        self.qNames = qNames
+        self.pattern = pattern
+        self.ttl = ttl
+        self.background = background
+        self.lock = threading.Lock()
+        self.cache = dict()
+        self.updated = 0
+        self.error = None      # last error raised by a background refresh
+        self.running = background
+        if background:
+            self.thread = threading.Thread(target=self.poll)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # refresh method - refreshes the cache
+    def refresh(self):
+        """refreshes the cache with the status of the queues"""
+
+        result = Amqp(self.amqp).qStatusMany(self.qNames, self.pattern)
+        with self.lock: (self.cache, self.updated) = (result, time.time())
+
+    # poll method - refreshes the cache every ttl secs until stopped
+    def poll(self):
+        """refreshes the cache every ttl secs until stop is called"""
+
+        while self.running:
+            try:
+                self.refresh()
+                self.error = None
+            except (error, pika.exceptions.AMQPError, socket.error) as e:
+                self.error = e
+            time.sleep(self.ttl)
+
+    # status method - returns the cached status of the queues
+    def status(self):
+        """returns a dict of qName: (exists, msgCount, consumerCount), refreshing it first
+           if it is older than ttl and not polled in the background"""
+
+        if not self.background and time.time() - self.updated >= self.ttl: self.refresh()
+        with self.lock: return dict(self.cache)
+
+    # stop method - stops the background thread
+    def stop(self):
+        """stops the background thread"""
+
+        self.running = False
+
+# AmqpConsumer - push-based streaming consumer with prefetch and batched acks
+class AmqpConsumer(object):
+    """
+    push-based consumer of a queue on a connected Amqp object using basic_consume with a 
+    basic_qos prefetch window; iterate to receive message bodies or call run(callback); a 
+    message counts as processed once the next one is requested and processed messages are 
+    acked in batches (multiple=True) every ackEvery messages or ackInterval secs; iteration 
+    ends after inactivity secs without messages (if set) or on cancel, which acks processed 
+    messages and requeues the rest; if properties is True, (properties, body) tuples are 
+    yielded instead of bodies
+    """
+
+    # constructor method - set prefetch and ack batching
+    def __init__(self, amqp, queue, prefetch=100, ackEvery=100, ackInterval=0.1, 
+                 inactivity=None, no_ack=False, properties=False):
+        """set prefetch and ack batching for consuming queue on connected Amqp object amqp"""
+
+        self.amqp = amqp
+        self.queue = queue
+        self.prefetch = prefetch
+        self.ackEvery = ackEvery
+        self.ackInterval = ackInterval
+        self.inactivity = inactivity
+        self.no_ack = no_ack
+        self.properties = properties
+        self.cancelled = False
+        self.delivered = 0   # last delivery tag handed to the caller
+        self.processed = 0   # last delivery tag processed by the caller
+        self.acked = 0       # last delivery tag acked
+        self.ackedAt = time.time()
+
+    # __iter__ method - yields message bodies as they are pushed by the broker
+    def __iter__(self):
+        """yields message bodies as they are pushed by the broker"""
+
+        channel = self.amqp.channel
+        idle = 0.0
+
+        try:
+            channel.basic_qos(prefetch_count=self.prefetch)
+            for m in channel.consume(self.queue, no_ack=self.no_ack, 
+                                     inactivity_timeout=self.ackInterval):
+                # on inactivity flush acks and stop if idle for too long
+                if m is None:
+                    self.ack(True)
+                    idle += self.ackInterval
+                    if self.inactivity is not None and idle >= self.inactivity: break
+                    continue
+                idle = 0.0
+                (method, properties, body) = m
+                self.delivered = method.delivery_tag
+                body = self.amqp.decode(body, properties)
+                yield (properties, body) if self.properties else body
+                if self.cancelled: break
+                # the caller requested another message, so the last one is processed
+                self.processed = self.delivered
+                self.ack()
+        except pika.exceptions.AMQPError as e:
+            raise error('AmqpConsumer', 'error', ' '.join([str(a) for a in e.args]))
+        finally:
+            self.cancel()
+
+    # run method - calls callback with each message body until cancelled or inactive
+    def run(self, callback):
+        """calls callback(body) for each message until cancelled or inactive"""
+
+        for body in self: callback(body)
+
+    # ack method - acks processed messages if a batch limit is reached
+    def ack(self, force=False):
+        """acks processed messages (multiple=True) if ackEvery or ackInterval is reached"""
+
+        if self.no_ack or self.processed <= self.acked: return
+        if (force or self.processed - self.acked >= self.ackEvery or
+            time.time() - self.ackedAt >= self.ackInterval):
+            self.amqp.channel.basic_ack(delivery_tag=self.processed, multiple=True)
+            (self.acked, self.ackedAt) = (self.processed, time.time())
+
+    # cancel method - stops consuming, acks processed messages and requeues the rest
+    def cancel(self):
+        """stops consuming, acks processed messages, requeues unprocessed messages, and 
+           releases the connection if the Amqp object is not persistent"""
+
+        if self.cancelled: return
+        self.cancelled = True
+        channel = self.amqp.channel
+
+        try:
+            if channel is not None and channel.is_open:
+                self.ack(True)
+                if not self.no_ack and self.delivered > self.processed:
+                    channel.basic_nack(delivery_tag=self.delivered, multiple=True, 
+                                       requeue=True)
+                channel.cancel()
+                channel.basic_qos(prefetch_count=0)
+        except pika.exceptions.AMQPError as e:
+            raise error('AmqpConsumer.cancel', 'error', ' '.join([str(a) for a in e.args]))
+        finally:
+            if not self.amqp.persistent: self.amqp.close()
+
+# amqpWorker - worker process loop for AmqpWorkerPool
+def amqpWorker(wid, handler, tasks, results):
+    """calls handler(message) for each (tag, message) task until a None task is received, 
+       putting (wid, tag, ok, error) on results after each"""
+
+    while True:
+        task = tasks.get()
+        if task is None: break
+        (tag, message) = task
+        try:
+            handler(message)
+            results.put((wid, tag, True, None))
+        except Exception as e:
+            results.put((wid, tag, False, str(e)))
+
+# AmqpWorkerPool - consumer supervisor that hands messages to worker processes
+class AmqpWorkerPool(object):
+    """
+    consumer supervisor that owns the broker connection and hands messages from a queue 
+    to a pool of worker processes running handler(message); prefetch is workers * perWorker
+    so the broker only pushes messages there are free worker slots for, each message is 
+    acked only after its worker finishes (failed messages are rejected, and requeued if 
+    requeue is True), and a worker that dies is restarted with its unacked messages 
+    requeued; stats() reports per-worker throughput
+    """
+
+    # constructor method - create a persistent amqp connection and set pool limits
+    def __init__(self, amqp, exchange, queue, key, handler, workers=None, perWorker=2, 
+                 requeue=False, idle=0.05):
+        """create a persistent amqp connection using amqp config and set pool limits"""
+
+        self.amqp = Amqp(dict(amqp.items() + [('persistent', True)]))
+        self.exchange = exchange
+        self.queue = queue
+        self.key = key
+        self.handler = handler
+        self.size = workers if workers else multiprocessing.cpu_count()
+        self.perWorker = perWorker
+        self.requeue = requeue
+        self.idle = idle
+        self.results = multiprocessing.Queue()
+        self.workers = list()
+        self.running = False
+
+    # start method - starts (or restarts) worker wid
+    def start(self, wid):
+        """starts worker process wid with a fresh task queue"""
+
+        tasks = multiprocessing.Queue()
+        process = multiprocessing.Process(target=amqpWorker, 
+                                          args=(wid, self.handler, tasks, self.results))
+        process.daemon = True
+        process.start()
+        w = {'process': process, 'tasks': tasks, 'inflight': dict(), 'done': 0, 
+             'failed': 0, 'restarts': 0, 'started': time.time()}
+        if wid < len(self.workers):
+            # keep the slot's counters across restarts
+            for k in ('done', 'failed', 'started'): w[k] = self.workers[wid][k]
+            w['restarts'] = self.workers[wid]['restarts'] + 1
+            self.workers[wid] = w
+        else:
+            self.workers.append(w)
+
+    # collect method - acks or rejects messages finished by workers
+    def collect(self, timeout=0):
+        """acks or rejects finished messages, waiting up to timeout secs for the first"""
+
+        channel = self.amqp.channel
+        block = timeout > 0
+        while True:
+            try:
+                (wid, tag, ok, e) = self.results.get(block, timeout)
+            except Queue.Empty:
+                return
+            block = False
+            # ignore results for messages requeued after their worker died
+            if tag not in self.workers[wid]['inflight']: continue
+            del self.workers[wid]['inflight'][tag]
+            if ok:
+                self.workers[wid]['done'] += 1
+                channel.basic_ack(delivery_tag=tag)
+            else:
+                self.workers[wid]['failed'] += 1
+                channel.basic_reject(delivery_tag=tag, requeue=self.requeue)
+
+    # check method - restarts dead workers and requeues their unacked messages
+    def check(self):
+        """restarts dead workers and requeues their unacked messages"""
+
+        for wid in range(len(self.workers)):
+            if self.workers[wid]['process'].is_alive(): continue
+            self.collect()
+            for tag in sorted(self.workers[wid]['inflight']):
+                self.amqp.channel.basic_nack(delivery_tag=tag, requeue=True)
+            self.workers[wid]['inflight'].clear()
+            if self.running: self.start(wid)
+
+    # run method - consumes the queue and dispatches messages until stopped or inactive
+    def run(self, inactivity=None):
+        """declares the exchange and queue, starts the workers, and dispatches messages to 
+           the least busy worker until stop is called or no message arrives for 
+           inactivity secs (if set)"""
+
+        exParams = dict(filter(lambda (k, v): k not in ['exchange'], self.exchange.items()))
+        qParams = dict(filter(lambda (k, v): k not in ['queue'], self.queue.items()))
+
+        try:
+            self.amqp.exDeclare(self.exchange['exchange'], exParams)
+            self.amqp.qDeclare(self.queue['queue'], self.exchange['exchange'], qParams, 
+                               self.key)
+            channel = self.amqp.channel
+            channel.basic_qos(prefetch_count=self.size * self.perWorker)
+
+            self.running = True
+            for wid in range(self.size): self.start(wid)
+            messages = channel.consume(self.queue['queue'], inactivity_timeout=self.idle)
+            idle = 0.0
+
+            while self.running:
+                # wait for results while every worker slot is busy
+                slots = self.size * self.perWorker
+                if sum([len(w['inflight']) for w in self.workers]) >= slots:
+                    self.collect(self.idle)
+                    self.amqp.conn.process_data_events()
+                    self.check()
+                    continue
+
+                # otherwise dispatch the next message to the least busy worker
+                m = next(messages)
+                self.collect()
+                if m is None:
+                    self.check()
+                    idle += self.idle
+                    if inactivity is not None and idle >= inactivity: break
+                    continue
+                idle = 0.0
+                (method, properties, body) = m
+                w = min(self.workers, key=lambda w: len(w['inflight']))
+                w['inflight'][method.delivery_tag] = True
+                w['tasks'].put((method.delivery_tag, self.amqp.decode(body, properties)))
+        except pika.exceptions.AMQPError as e:
+            raise error('AmqpWorkerPool', 'error', ' '.join([str(a) for a in e.args]))
+        finally:
+            self.shutdown()
+
+    # stop method - stops dispatching messages
+    def stop(self):
+        """stops dispatching messages; run finishes in-flight messages and returns"""
+
+        self.running = False
+
+    # shutdown method - finishes in-flight messages, stops workers and closes the connection
+    def shutdown(self, timeout=30):
+        """stops consuming, waits up to timeout secs for in-flight messages, stops the 
+           workers, and closes the connection (unfinished messages are requeued)"""
+
+        self.running = False
+        channel = self.amqp.channel
+
+        try:
+            if channel is not None and channel.is_open:
+                channel.cancel()
+                deadline = time.time() + timeout
+                while (time.time() < deadline and 
+                       sum([len(w['inflight']) for w in self.workers])):
+                    self.collect(self.idle)
+                    self.check()
+            for w in self.workers:
+                w['tasks'].put(None)
+                w['process'].join(1)
+                if w['process'].is_alive(): w['process'].terminate()
+        finally:
+            self.amqp.close()
+
+    # stats method - returns per-worker throughput
+    def stats(self):
+        """returns a list of dicts (pid, done, failed, inflight, restarts, rate) per worker, 
+           where rate is messages done per sec since the worker started"""
+
+        now = time.time()
+        return [{'pid': w['process'].pid, 'done': w['done'], 'failed': w['failed'],
+                 'inflight': len(w['inflight']), 'restarts': w['restarts'],
+                 'rate': w['done'] / max(now - w['started'], 1e-6)} for w in self.workers]
+
+# AmqpPublisher - buffers messages and publishes them in confirmed batches
+class AmqpPublisher(object):
+    """
+    buffers (exchange, key, message) messages and publishes them with Amqp.publishBatch 
+    when maxMessages are buffered or maxDelay secs have passed since the first buffered 
+    message (checked on publish and by a daemon thread, so a burst is sent even if no more
+    messages follow); nacked messages are returned by flush and kept in nacked; messages
+    whose publish raised stay buffered for the next flush; call close to stop the thread
+    """
+
+    # constructor method - create a persistent amqp connection and an empty buffer
+    def __init__(self, amqp, maxMessages=1000, maxDelay=0.5, window=1000, timeout=30):
+        """create a persistent amqp connection using amqp config and an empty buffer, and 
+           start the flush thread"""
+
+        self.amqp = Amqp(dict(amqp.items() + [('persistent', True)]))
+        self.maxMessages = maxMessages
+        self.maxDelay = maxDelay
+        self.window = window
+        self.timeout = timeout
+        self.buffer = list()
+        self.nacked = list()
+        self.started = None
+        self.lock = threading.RLock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.poll)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # publish method - buffers a message and flushes the buffer if a limit is hit
+    def publish(self, exchange, message='', key=''):
+        """buffers a message; flushes when maxMessages or maxDelay is reached"""
+
+        with self.lock:
+            if self.started is None: self.started = time.time()
+            self.buffer.append((exchange, key, message))
+            if (len(self.buffer) >= self.maxMessages or 
+                time.time() - self.started >= self.maxDelay): self.flush()
+
+    # poll method - flushes buffered messages once maxDelay has passed
+    def poll(self):
+        """flushes buffered messages maxDelay secs after the first was buffered, until 
+           close is called; errors are written to stderr and the messages kept"""
+
+        while not self.stopping.wait(min(self.maxDelay, 0.1)):
+            with self.lock:
+                if self.started is None or time.time() - self.started < self.maxDelay: 
+                    continue
+                try:
+                    self.flush()
+                except (error, pika.exceptions.AMQPError, socket.error) as e:
+                    sys.stderr.write('AmqpPublisher: {0}{1}'.format(e, os.linesep))
+
+    # flush method - publishes buffered messages and returns nacked messages
+    def flush(self):
+        """publishes buffered messages with confirms, returns list of nacked messages"""
+
+        with self.lock:
+            (messages, self.buffer, self.started) = (self.buffer, list(), None)
+            try:
+                nacked = self.amqp.publishBatch(messages, self.window, self.timeout) \
+                    if messages else list()
+            except Exception:
+                # keep the messages buffered (ahead of any new ones) for the next flush
+                self.buffer = messages + self.buffer
+                self.started = time.time() if self.buffer else None
+                raise
+            self.nacked.extend(nacked)
+
+        return nacked
+
+    # close method - flushes buffered messages and closes the amqp connection
+    def close(self):
+        """stops the flush thread, flushes buffered messages, and closes the amqp 
+           connection"""
+
+        self.stopping.set()
+        with self.lock:
+            self.flush()
+            self.amqp.close()
+
+# AsyncAmqp - asynchronous amqp client mirroring the Amqp interface on one ioloop
+class AsyncAmqp(object):
+    """
+    asynchronous amqp client mirroring the Amqp interface on a single pika SelectConnection 
+    ioloop; operations take a callback instead of returning a value and never block, so 
+    many producers and consumers share one connection and thread; publishes and 
+    declarations share a control channel, each consumer gets its own channel, and 
+    operations issued before the connection is open are queued; call run() to start the 
+    ioloop and stop() to close the connection and end it
+    """
+
+    # constructor method - initialize exchange and queue dicts and connection parameters
+    def __init__(self, amqp):
+        """initialize exchange and queue attributes and connection parameters"""
+
+        # create exchange, queue, and in-flight declaration dicts and pending operation list
+        self.exchanges = dict()
+        self.queues = dict()
+        self.waiting = dict()
+        self.pending = list()
+
+        # separate out amqp parameters from credentials
+        excludeKeys = ['username','password','persistent','pooled','codec','compress','spool']
+        self.params = dict(filter(lambda (k, v): k not in excludeKeys, amqp.items()))
+        self.username = 'guest' if 'username' not in amqp.keys() else amqp['username']
+        self.password = 'guest' if 'password' not in amqp.keys() else amqp['password']
+        self.codec = None if 'codec' not in amqp.keys() else amqp['codec']
+        self.compress = None if 'compress' not in amqp.keys() else amqp['compress']
+        self.conn = None
+        self.channel = None
+        self.stopping = False
+
+        # create logging handler for pika warnings
+        logging.basicConfig()
+
+    # connect method - starts opening the connection on the ioloop
+    def connect(self):
+        """starts opening the connection; the ioloop must be running (see run)"""
+
+        c = pika.PlainCredentials(self.username, self.password)
+        p = pika.ConnectionParameters(credentials=c, **self.params)
+        self.conn = pika.SelectConnection(p, on_open_callback=self.onOpen, 
+                                          on_open_error_callback=self.onOpenError,
+                                          on_close_callback=self.onClose,
+                                          stop_ioloop_on_close=False)
+
+    # run method - connects, if required, and runs the ioloop until stop is called
+    def run(self):
+        """connects, if required, and runs the ioloop until stop is called"""
+
+        if self.conn is None: self.connect()
+        self.stopping = False
+        self.conn.ioloop.start()
+
+    # stop method - closes the connection and stops the ioloop
+    def stop(self):
+        """closes the connection and stops the ioloop once it is closed"""
+
+        self.stopping = True
+        if self.conn is not None and self.conn.is_open: self.conn.close()
+        elif self.conn is not None: self.conn.ioloop.stop()
+
+    # onOpen method - opens the control channel once the connection is open
+    def onOpen(self, conn):
+        """opens the control channel once the connection is open"""
+
+        conn.channel(on_open_callback=self.onChannel)
+
+    # onOpenError method - raises an error from the ioloop if the connection fails
+    def onOpenError(self, conn, e):
+        """raises an error from the ioloop if the connection cannot be opened"""
+
+        self.conn = None
+        raise error('AsyncAmqp.connect', 'error', str(e))
+
+    # onClose method - resets state and stops the ioloop if stopping
+    def onClose(self, conn, code, text):
+        """resets connection state and stops the ioloop if stop was called"""
+
+        (self.conn, self.channel) = (None, None)
+        if self.stopping: conn.ioloop.stop()
+
+    # onChannel method - runs queued operations once the control channel is open
+    def onChannel(self, channel):
+        """saves the control channel and runs queued operations"""
+
+        self.channel = channel
+        channel.add_on_close_callback(self.onChannelClose)
+        (pending, self.pending) = (self.pending, list())
+        for fn in pending: fn(channel)
+
+    # onChannelClose method - reopens the control channel if the connection is still open
+    def onChannelClose(self, channel, code, text):
+        """reopens the control channel if the connection is still open"""
+
+        self.channel = None
+        if self.conn is not None and self.conn.is_open and not self.stopping: 
+            self.conn.channel(on_open_callback=self.onChannel)
+
+    # withChannel method - calls fn with the control channel once it is open
+    def withChannel(self, fn):
+        """calls fn(channel) now if the control channel is open, otherwise once it opens"""
+
+        if self.channel is not None and self.channel.is_open: return fn(self.channel)
+        self.pending.append(fn)
+        if self.conn is None: self.connect()
+
+    # __once method - runs start once for name, queuing callbacks while it is in flight
+    def __once(self, name, start, callback):
+        """runs start(done) once for name and calls every queued callback when done"""
+
+        if name in self.waiting: return self.waiting[name].append(callback)
+        self.waiting[name] = [callback]
+        def done():
+            for cb in self.waiting.pop(name): cb()
+        start(done)
+
+    # __all method - runs each start concurrently and calls callback when all are done
+    @staticmethod
+    def __all(starts, callback=None):
+        """runs each start(done) and calls callback once every start has called done"""
+
+        count = [len(starts)]
+        def done():
+            count[0] -= 1
+            if not count[0] and callback: callback()
+        if not starts and callback: callback()
+        for start in starts: start(done)
+
+    # encode method - encodes a message with the codec, if any
+    def encode(self, message):
+        """returns (body, properties) for message using the codec and compress settings"""
+
+        if self.codec is None: return (message, None)
+        return amqpEncode(self.codec, message, self.compress)
+
+    # decode method - decodes a received body with the codec, if any
+    def decode(self, body, properties):
+        """returns the message for a received body if a codec is set, otherwise the body"""
+
+        return body if self.codec is None else amqpDecode(body, properties)
+
+    # exDeclare method - declares an exchange
+    def exDeclare(self, exName, exParams, callback=None):
+        """declares an exchange, if not already declared, and calls callback()"""
+
+        callback = callback if callback else lambda: None
+        if exName in self.exchanges: return callback()
+
+        def start(done):
+            def declared(frame):
+                self.exchanges[exName] = exParams
+                done()
+            self.withChannel(lambda ch: ch.exchange_declare(declared, exchange=exName, 
+                                                            **exParams))
+
+        self._AsyncAmqp__once(('exchange', exName), start, callback)
+
+    # qDeclare method - declares and binds a queue to an exchange
+    def qDeclare(self, qName, exName, qParams, key, callback=None):
+        """declares and binds a queue to an exchange, if not already done, and calls 
+           callback()"""
+
+        callback = callback if callback else lambda: None
+        if qName in self.queues: return callback()
+
+        def start(done):
+            def bound(frame):
+                self.queues[qName] = dict(qParams.items() + [('exchange', exName),
+                                                             ('routing_key', key)])
+                done()
+            def declared(frame):
+                self.withChannel(lambda ch: ch.queue_bind(bound, queue=qName, 
+                                                          exchange=exName, routing_key=key))
+            self.withChannel(lambda ch: ch.queue_declare(declared, queue=qName, **qParams))
+
+        self._AsyncAmqp__once(('queue', qName), start, callback)
+
+    # publish method - declares an exchange and publishes a message
+    def publish(self, exchange, message='', key='', callback=None):
+        """declares an exchange and publishes a message, calling callback() once the 
+           message is written to the connection (use Amqp.publishBatch for confirms)"""
+
+        # separate out exchange parameters
+        exParams = dict(filter(lambda (k, v): k not in ['exchange'], exchange.items()))
+
+        (body, properties) = self.encode(message)
+        def send():
+            self.withChannel(lambda ch: ch.basic_publish(exchange['exchange'], key, body, 
+                                                         properties))
+            if callback: callback()
+
+        self.exDeclare(exchange['exchange'], exParams, send)
+
+    # consume method - declares an exchange and queue and pushes messages to callback
+    def consume(self, exchange, queue, key=None, callback=None, **settings):
+        """
+        declares an exchange and queue and calls callback(body) for each message pushed 
+        from the queue on a dedicated channel; settings are passed to AsyncAmqpConsumer 
+        (prefetch, ackEvery, ackInterval, no_ack); returns the consumer for cancellation
+        """
+
+        # separate out exchange & queue parameters
+        exParams = dict(filter(lambda (k, v): k not in ['exchange'], exchange.items()))
+        qParams = dict(filter(lambda (k, v): k not in ['queue'], queue.items()))
+
+        consumer = AsyncAmqpConsumer(self, queue['queue'], callback, **settings)
+        self.exDeclare(exchange['exchange'], exParams, 
+                       lambda: self.qDeclare(queue['queue'], exchange['exchange'], qParams, 
+                                             key, consumer.start))
+
+        return consumer
+
+    # qStatus method - checks the status of a queue and calls back with (exists, msgCount)
+    def qStatus(self, qName, callback):
+        """checks the status of a queue on a separate channel (a 404 closes the channel) 
+           and calls callback((exists, msgCount))"""
+
+        result = list()
+
+        def onChannel(channel):
+            def onDeclare(frame):
+                result.append((True, frame.method.message_count))
+                channel.close()
+                callback(result[0])
+            def onClose(channel, code, text):
+                if result: return
+                # if error is other than 404 (queue doesn't exist), raise
+                if code != 404: raise error('AsyncAmqp.qStatus', 'error', str(code), text)
+                result.append((False, 0))
+                callback(result[0])
+            channel.add_on_close_callback(onClose)
+            channel.queue_declare(onDeclare, queue=qName, passive=True)
+
+        self.withChannel(lambda ch: self.conn.channel(on_open_callback=onChannel))
+
+    # qDelete method - unbinds, purges, and deletes one or all queues
+    def qDelete(self, qName=None, callback=None):
+        """unbinds, purges, and deletes one or all queues and calls callback()"""
+
+        def delete(q, p):
+            def start(done):
+                def unbound(frame): 
+                    self.withChannel(lambda ch: ch.queue_purge(purged, queue=q))
+                def purged(frame):
+                    self.withChannel(lambda ch: ch.queue_delete(lambda f: done(), queue=q))
+                self.withChannel(lambda ch: ch.queue_unbind(unbound, queue=q, 
+                                                            exchange=p['exchange'],
+                                                            routing_key=p['routing_key']))
+            return start
+
+        # step through queues and delete if the queue is named or no q name was passed
+        starts = list()
+        for q in self.queues.keys():
+            if qName == None or q == qName: starts.append(delete(q, self.queues.pop(q)))
+        self._AsyncAmqp__all(starts, callback)
+
+    # exDelete method - deletes one or all exchanges
+    def exDelete(self, exName=None, callback=None):
+        """deletes one or all exchanges and calls callback()"""
+
+        def delete(ex):
+            def start(done):
+                self.withChannel(lambda ch: ch.exchange_delete(lambda f: done(), exchange=ex))
+            return start
+
+        # step through exchanges and delete if the ex is named or no ex name was passed
+        starts = list()
+        for ex in self.exchanges.keys():
+            if exName == None or ex == exName:
+                del self.exchanges[ex]
+                starts.append(delete(ex))
+        self._AsyncAmqp__all(starts, callback)
+
+# AsyncAmqpConsumer - push consumer on its own channel of an AsyncAmqp connection
+class AsyncAmqpConsumer(object):
+    """
+    push consumer of a queue on its own channel of an AsyncAmqp connection; calls 
+    callback(body) for each message and acks handled messages in batches (multiple=True) 
+    every ackEvery messages or ackInterval secs; cancel closes the channel, which requeues 
+    any unacked messages
+    """
+
+    # constructor method - set prefetch and ack batching
+    def __init__(self, amqp, queue, callback, prefetch=100, ackEvery=100, ackInterval=0.1,
+                 no_ack=False):
+        """set prefetch and ack batching for consuming queue on AsyncAmqp object amqp"""
+
+        self.amqp = amqp
+        self.queue = queue
+        self.callback = callback
+        self.prefetch = prefetch
+        self.ackEvery = ackEvery
+        self.ackInterval = ackInterval
+        self.no_ack = no_ack
+        self.channel = None
+        self.consumerTag = None
+        self.cancelled = False
+        self.processed = 0   # last delivery tag handled by callback
+        self.acked = 0       # last delivery tag acked
+        self.timer = None
+
+    # start method - opens the consumer channel, sets prefetch and starts consuming
+    def start(self):
+        """opens the consumer channel, sets prefetch and starts consuming"""
+
+        def consume(frame):
+            self.consumerTag = self.channel.basic_consume(self.onMessage, queue=self.queue,
+                                                          no_ack=self.no_ack)
+        def onChannel(channel):
+            self.channel = channel
+            if self.cancelled: return channel.close()
+            channel.basic_qos(consume, prefetch_count=self.prefetch)
+
+        if not self.cancelled: self.amqp.conn.channel(on_open_callback=onChannel)
+
+    # onMessage method - calls callback with the message body and batches acks
+    def onMessage(self, channel, method, properties, body):
+        """calls callback(body) and acks handled messages in batches; messages arriving
+           after cancel are left unacked and requeued when the channel closes"""
+
+        if self.cancelled: return
+        self.callback(self.amqp.decode(body, properties))
+        if self.no_ack or not channel.is_open: return
+        self.processed = method.delivery_tag
+        if self.processed - self.acked >= self.ackEvery: self.ack()
+        elif self.timer is None:
+            self.timer = self.amqp.conn.add_timeout(self.ackInterval, self.ack)
+
+    # ack method - acks handled messages
+    def ack(self):
+        """acks handled messages (multiple=True)"""
+
+        if self.timer is not None: self.amqp.conn.remove_timeout(self.timer)
+        self.timer = None
+        if self.processed > self.acked and self.channel.is_open:
+            self.channel.basic_ack(delivery_tag=self.processed, multiple=True)
+            self.acked = self.processed
+
+    # cancel method - stops consuming, acks handled messages, and closes the channel
+    def cancel(self):
+        """stops consuming, acks handled messages, and closes the channel"""
+
+        self.cancelled = True
+        if self.channel is None or not self.channel.is_open: return
+        self.ack()
+        if self.consumerTag is None: return self.channel.close()
+        self.channel.basic_cancel(lambda frame: self.channel.close(), self.consumerTag)
+
+# AmqpRpcClient - pipelined rpc client with a shared exclusive reply queue
+class AmqpRpcClient(object):
+    """
+    rpc client that publishes requests to an exchange and matches replies on one exclusive
+    reply queue by correlation_id, so many requests can be in flight at once; send returns
+    a request id immediately, result waits for its reply (up to the request's timeout), 
+    and call does both
+    """
+
+    # constructor method - create a persistent connection and consume the reply queue
+    def __init__(self, amqp, exchange, timeout=30):
+        """create a persistent connection using amqp config, declare the exchange, and 
+           consume replies from an exclusive server-named reply queue"""
+
+        self.amqp = Amqp(dict(amqp.items() + [('persistent', True)]))
+        self.exchange = exchange
+        self.timeout = timeout
+        self.pending = dict()  # request id -> deadline
+        self.results = dict()  # request id -> (reply, error)
+
+        exParams = dict(filter(lambda (k, v): k not in ['exchange'], exchange.items()))
+
+        try:
+            self.amqp.exDeclare(exchange['exchange'], exParams)
+            channel = self.amqp.channel
+            self.replyTo = channel.queue_declare(queue='', exclusive=True, 
+                                                 auto_delete=True).method.queue
+            channel.basic_consume(self.onReply, queue=self.replyTo, no_ack=True)
+        except pika.exceptions.AMQPError as e:
+            raise error('AmqpRpcClient', 'error', ' '.join([str(a) for a in e.args]))
+
+    # onReply method - saves replies to pending requests
+    def onReply(self, channel, method, properties, body):
+        """saves the reply to a pending request; late replies are dropped"""
+
+        cid = properties.correlation_id
+        if cid not in self.pending: return
+        del self.pending[cid]
+        headers = properties.headers if properties.headers else dict()
+        self.results[cid] = (self.amqp.decode(body, properties), headers.get('error'))
+
+    # send method - publishes a request and returns its id
+    def send(self, key, message='', timeout=None):
+        """publishes a request with routing key and returns its request id"""
+
+        cid = uuid.uuid4().hex
+        (body, properties) = self.amqp.encode(message)
+        properties = properties if properties is not None else pika.BasicProperties()
+        (properties.reply_to, properties.correlation_id) = (self.replyTo, cid)
+        timeout = timeout if timeout is not None else self.timeout
+
+        try:
+            self.amqp.channel.basic_publish(exchange=self.exchange['exchange'], 
+                                            routing_key=key, body=body, 
+                                            properties=properties)
+        except pika.exceptions.AMQPError as e:
+            raise error('AmqpRpcClient.send', 'error', ' '.join([str(a) for a in e.args]))
+        self.pending[cid] = time.time() + timeout
+
+        return cid
+
+    # result method - waits for and returns the reply to a request
+    def result(self, cid):
+        """waits for and returns the reply to request cid; raises an error if the server 
+           handler failed or no reply arrived before the request's timeout"""
+
+        try:
+            while cid not in self.results:
+                if cid not in self.pending or time.time() > self.pending[cid]:
+                    self.pending.pop(cid, None)
+                    raise error('AmqpRpcClient.result', 'timeout', cid)
+                self.amqp.conn.process_data_events(time_limit=0.01)
+        except pika.exceptions.AMQPError as e:
+            raise error('AmqpRpcClient.result', 'error', ' '.join([str(a) for a in e.args]))
+
+        (reply, e) = self.results.pop(cid)
+        if e is not None: raise error('AmqpRpcClient.result', 'error', e)
+
+        return reply
+
+    # call method - publishes a request and waits for its reply
+    def call(self, key, message='', timeout=None):
+        """publishes a request with routing key and returns its reply"""
+
+        return self.result(self.send(key, message, timeout))
+
+    # close method - closes the connection (and the exclusive reply queue)
+    def close(self):
+        """closes the connection, which deletes the exclusive reply queue"""
+
+        self.amqp.close()
+
+# AmqpRpcServer - rpc server that replies to requests using a streaming consumer
+class AmqpRpcServer(object):
+    """
+    rpc server that consumes requests with Amqp.stream and publishes handler(message) to
+    each request's reply_to queue with its correlation_id; handler exceptions are returned
+    to the client as an 'error' header
+    """
+
+    # constructor method - create a persistent connection
+    def __init__(self, amqp, exchange, queue, key, handler, **settings):
+        """create a persistent connection using amqp config; settings are passed to 
+           AmqpConsumer (prefetch, ackEvery, ackInterval, inactivity)"""
+
+        self.amqp = Amqp(dict(amqp.items() + [('persistent', True)]))
+        self.exchange = exchange
+        self.queue = queue
+        self.key = key
+        self.handler = handler
+        self.settings = settings
+        self.consumer = None
+
+    # run method - serves requests until stopped or inactive
+    def run(self):
+        """serves requests until stop is called or the consumer becomes inactive"""
+
+        self.consumer = self.amqp.stream(self.exchange, self.queue, self.key, properties=True,
+                                         **self.settings)
+
+        for (request, message) in self.consumer:
+            try:
+                (reply, headers) = (self.handler(message), None)
+            except Exception as e:
+                (reply, headers) = ('', {'error': str(e)})
+            if not request.reply_to: continue
+            (body, properties) = self.amqp.encode('' if reply is None else reply)
+            properties = properties if properties is not None else pika.BasicProperties()
+            (properties.correlation_id, properties.headers) = (request.correlation_id, headers)
+            try:
+                self.amqp.channel.basic_publish(exchange='', routing_key=request.reply_to, 
+                                                body=body, properties=properties)
+            except pika.exceptions.AMQPError as e:
+                raise error('AmqpRpcServer', 'error', ' '.join([str(a) for a in e.args]))
+
+        self.amqp.close()
+
+    # stop method - stops serving requests
+    def stop(self):
+        """stops serving requests (unprocessed requests are requeued)"""
+
+        if self.consumer is not None: self.consumer.cancel()
+
+# AmqpSpool - append-only memory-mapped spool for messages published during outages
+class AmqpSpool(object):
+    """
+    append-only spool of (exchange, key, message) records in memory-mapped segment files
+    under path, written by Amqp.publish when the broker is unreachable; records are 
+    msync'ed every syncEvery records or syncInterval secs, and a background thread replays
+    closed segments in confirmed batches of up to batch messages once the broker is back,
+    deleting each segment when it is confirmed (delivery is at-least-once); segments left
+    by processes that are no longer running are claimed (renamed) by one live process and
+    replayed as well; a segment with a torn record has the records before it replayed 
+    and is renamed to *.spool.bad
+    """
+
+    # constructor method - create the spool dir and start replaying orphaned segments
+    def __init__(self, path, amqp, segmentSize=16777216, syncEvery=1000, syncInterval=0.5,
+                 batch=10000, retry=1.0):
+        """create spool dir path and replay any orphaned segments using amqp config"""
+
+        if not os.path.isdir(path): os.makedirs(path)
+        self.path = path
+        self.amqp = dict([(k, v) for (k, v) in amqp.items() if k != 'spool'] +
+                         [('persistent', True), ('pooled', False)])
+        self.segmentSize = segmentSize
+        self.syncEvery = syncEvery
+        self.syncInterval = syncInterval
+        self.batch = batch
+        self.retry = retry
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+        self.seq = 0           # sequence number of the active segment
+        self.fh = None         # active segment file and map
+        self.mm = None
+        self.pos = 0           # write offset in the active segment
+        self.count = 0         # records spooled by this process and not yet replayed
+        self.unsynced = 0
+        self.synced = time.time()
+        self.thread = None
+
+        if self.segments(): self.wake()
+
+    # append method - appends a message record to the active segment
+    def append(self, exchange, key, message):
+        """appends an (exchange, key, message) record and wakes the replay thread"""
+
+        try:
+            record = marshal.dumps((exchange, key, amqpView(message)))
+        except ValueError as e:
+            raise error('AmqpSpool.append', 'error', str(e))
+
+        with self.lock:
+            n = len(record) + 4
+            if self.mm is None or self.pos + n > len(self.mm): self.open(n)
+            self.mm[self.pos:self.pos + n] = struct.pack('!I', len(record)) + record
+            (self.pos, self.count, self.unsynced) = (self.pos + n, self.count + 1, 
+                                                     self.unsynced + 1)
+            if (self.unsynced >= self.syncEvery or 
+                time.time() - self.synced >= self.syncInterval): self.sync()
+
+        self.wake()
+
+    # sync method - flushes the active segment to disk
+    def sync(self):
+        """flushes (msync) the active segment to disk"""
+
+        with self.lock:
+            if self.mm is not None: self.mm.flush()
+            (self.unsynced, self.synced) = (0, time.time())
+
+    # open method - closes the active segment and opens a new one
+    def open(self, size=0):
+        """closes the active segment and opens a new one of at least size bytes"""
+
+        with self.lock:
+            self.close()
+            self.seq += 1
+            name = os.path.join(self.path, '{0}.{1:012d}.spool'.format(self.pid, self.seq))
+            self.fh = open(name, 'w+b')
+            self.fh.truncate(max(self.segmentSize, size))
+            self.mm = mmap.mmap(self.fh.fileno(), max(self.segmentSize, size))
+            self.pos = 0
+
+    # close method - syncs and closes the active segment
+    def close(self):
+        """syncs and closes the active segment, deleting it if it is empty"""
+
+        with self.lock:
+            if self.mm is None: return
+            self.sync()
+            self.mm.close()
+            self.fh.close()
+            if not self.pos: os.remove(self.fh.name)
+            (self.mm, self.fh, self.pos) = (None, None, 0)
+
+    # segments method - returns closed segments to replay in order
+    def segments(self):
+        """returns closed segment file names of this process and of processes that are no
+           longer running, oldest first"""
+
+        result = list()
+        active = self.fh.name if self.fh is not None else None
+        for name in glob.glob(os.path.join(self.path, '*.spool')):
+            (pid, seq) = os.path.basename(name).split('.')[:2]
+            if name == active: continue
+            if int(pid) != self.pid:
+                try:
+                    os.kill(int(pid), 0)
+                    continue
+                except OSError:
+                    pass
+            result.append((int(pid), seq, name))
+
+        return [r[2] for r in sorted(result)]
+
+    # read method - returns the records in a segment file
+    @staticmethod
+    def read(name):
+        """returns (records, torn) for segment file name, where records are the 
+           (exchange, key, message) records before the first torn record, if any"""
+
+        (records, torn) = (list(), False)
+        with open(name, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            if not size: return (records, torn)
+            mm = mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+            pos = 0
+            while pos + 4 <= size:
+                (n,) = struct.unpack('!I', mm[pos:pos + 4])
+                if not n: break
+                try:
+                    if pos + 4 + n > size: raise EOFError('record past end of segment')
+                    records.append(marshal.loads(mm[pos + 4:pos + 4 + n]))
+                except (ValueError, EOFError, TypeError):
+                    torn = True
+                    break
+                pos += 4 + n
+            mm.close()
+
+        return (records, torn)
+
+    # wake method - starts the replay thread if it is not running
+    def wake(self):
+        """starts the replay thread if it is not running"""
+
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive(): return
+            self.thread = threading.Thread(target=self.replay)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # replay method - replays spooled messages until the spool is empty
+    def replay(self):
+        """replays spooled segments in confirmed batches until the spool is empty, retrying
+           every retry secs while the broker is unreachable; nacked messages are spooled 
+           again"""
+
+        amqp = Amqp(self.amqp)
+
+        while True:
+            # close the active segment so everything spooled so far can be replayed
+            with self.lock:
+                self.close()
+                segments = self.segments()
+                if not segments:
+                    self.count = 0
+                    self.thread = None
+                    break
+
+            try:
+                for name in segments:
+                    parts = os.path.basename(name).split('.')
+                    own = len(parts) == 3 and int(parts[0]) == self.pid
+                    # claim an orphaned segment with an atomic rename to {pid}.{seq}.{old 
+                    # pid}.spool, so only one live process replays it
+                    if int(parts[0]) != self.pid:
+                        claimed = os.path.join(self.path, '{0}.{1}.{2}.spool'.format(
+                            self.pid, parts[1], parts[0]))
+                        try:
+                            os.rename(name, claimed)
+                        except OSError:
+                            continue
+                        name = claimed
+                    (records, torn) = AmqpSpool.read(name)
+                    for i in range(0, len(records), self.batch):
+                        for m in amqp.publishBatch(records[i:i + self.batch]): self.append(*m)
+                    # quarantine a segment with a torn record so it is not replayed again
+                    if torn: os.rename(name, name + '.bad')
+                    else: os.remove(name)
+                    if own:
+                        with self.lock: self.count = max(self.count - len(records), 0)
+            except (error, pika.exceptions.AMQPError, socket.error, OSError, IOError):
+                try:
+                    amqp.close()
+                except (error, pika.exceptions.AMQPError, socket.error):
+                    (amqp.conn, amqp.channel, amqp.confirms) = (None, None, None)
+                time.sleep(self.retry)
+
+        amqp.close()
+
+# amqpSpools - spools by (path, pid); each process spools and replays on its own
+amqpSpools = dict()
+
+# amqpSpool - returns the shared spool for an amqp config with a 'spool' path
+def amqpSpool(amqp):
+    """returns this process's AmqpSpool for the 'spool' path in amqp config, creating it on 
+       first use"""
+
+    k = (os.path.abspath(amqp['spool']), os.getpid())
+    if k not in amqpSpools: amqpSpools[k] = AmqpSpool(amqp['spool'], amqp)
+
+    return amqpSpools[k]
+
 # amqpPublish - publishes an amqp message
 def amqpPublish(amqp, ex, key='', message=''):
     """publishes an amqp message to exchange using amqp config and routing key"""
@@ -299,6 +1959,64 @@ def main():
     message = Amqp(amqp).consume(exchange=ex, queue=q, key=q['queue'])
     print aColor('BLUE') + 'Amqp.publish/qStatus/consume...', aColor('OFF'), message, status
     print aColor('BLUE') + 'Amqp.qStatus...', aColor('OFF'), a.qStatus(qName='blahblah')
+    a.connect()
+    conn = a.conn
+    a.close()
+    a.connect()
+    print aColor('BLUE') + 'AmqpPool...', aColor('OFF'), a.conn is conn
+    a.close()
+    exParams = dict([(k, v) for (k, v) in ex.items() if k != 'exchange'])
+    print aColor('BLUE') + 'AmqpTopology...', aColor('OFF'), \
+        amqpTopology.cached(a.key, 'exchange', ex['exchange'], exParams)
+    nacked = a.publishBatch([(ex, q['queue'], str(i)) for i in range(100)])
+    print aColor('BLUE') + 'Amqp.publishBatch...', aColor('OFF'), nacked, a.qStatus(q['queue'])
+    p = AmqpPublisher(amqp, maxMessages=10)
+    for i in range(25): p.publish(ex, str(i), q['queue'])
+    p.close()
+    print aColor('BLUE') + 'AmqpPublisher...', aColor('OFF'), p.nacked, a.qStatus(q['queue'])
+    bodies = [b for b in Amqp(amqp).stream(ex, q, q['queue'], prefetch=50, inactivity=0.5)]
+    print aColor('BLUE') + 'Amqp.stream...', aColor('OFF'), len(bodies), a.qStatus(q['queue'])
+    aa = AsyncAmqp(amqp)
+    received = list()
+    def asyncStatus():
+        aa.qStatus(q['queue'], lambda status: received.append(status) or aa.stop())
+    def asyncReceive(body):
+        received.append(body)
+        if len(received) == 10: 
+            consumer.cancel()
+            aa.conn.add_timeout(0.5, asyncStatus)
+    consumer = aa.consume(ex, q, q['queue'], asyncReceive)
+    for i in range(10): aa.publish(ex, str(i), q['queue'])
+    aa.run()
+    print aColor('BLUE') + 'AsyncAmqp...', aColor('OFF'), received
+    c = Amqp(dict(amqp.items() + [('codec', 'marshal'), ('compress', 64)]))
+    c.publish(ex, {'bid': [1.5] * 100, 'ask': 'x' * 10}, q['queue'])
+    print aColor('BLUE') + 'amqpCodecs...', aColor('OFF'), c.consume(ex, q, q['queue'])
+    for i in range(20): a.publish(ex, str(i), q['queue'])
+    w = AmqpWorkerPool(amqp, ex, q, q['queue'], len, workers=2)
+    w.run(inactivity=0.5)
+    print aColor('BLUE') + 'AmqpWorkerPool...', aColor('OFF'), \
+        [(s['done'], s['failed']) for s in w.stats()], a.qStatus(q['queue'])
+    rq = dict(q.items() + [('queue', 'testRpcQ')])
+    print aColor('BLUE') + 'Amqp.qStatusMany...', aColor('OFF'), \
+        a.qStatusMany([q['queue'], 'blahblah', 'blahblah2', q['queue']])
+    monitor = AmqpMonitor(amqp, pattern='^test', ttl=1, background=True)
+    time.sleep(0.5)
+    print aColor('BLUE') + 'AmqpMonitor...', aColor('OFF'), monitor.status()
+    monitor.stop()
+    server = multiprocessing.Process(target=AmqpRpcServer(amqp, ex, rq, 'rpc', 
+                                                          lambda m: m.upper(), 
+                                                          inactivity=2).run)
+    server.start()
+    rpc = AmqpRpcClient(amqp, ex, timeout=5)
+    cids = [rpc.send('rpc', 'request {0}'.format(i)) for i in range(5)]
+    print aColor('BLUE') + 'AmqpRpcClient...', aColor('OFF'), [rpc.result(c) for c in cids]
+    rpc.close()
+    server.join()
+    sp = Amqp(dict(amqp.items() + [('port', 5999), ('spool', 'test.spool')]))
+    for i in range(10): sp.publish(ex, str(i), q['queue'])
+    print aColor('BLUE') + 'AmqpSpool...', aColor('OFF'), amqpSpool(sp.spool).count, \
+        os.listdir('test.spool')
 
 if __name__ == '__main__':
 
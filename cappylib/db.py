@@ -40,27 +40,431 @@
 # IMPORTS 
 ##############################################################################################
 
-import mysql.connector
+import mysql.connector, os, sys, re, threading, time, array, collections, Queue
 from cappylib.general import *
 
 ##############################################################################################
 # GLOBAL VARS 
 ##############################################################################################
 
+mysqlTemplates = dict()   # (query, list lengths) -> (compiled query, list input keys)
+mysqlTemplatesMax = 1024  # compiled query templates cached before the cache is cleared
+mysqlRecords = dict()     # column names -> generated record class
+
 ##############################################################################################
 # MAIN CODE
 ##############################################################################################
 
+# DbPool - process-wide pool of mysql connections
+class DbPool(object):
+    """
+    pool of mysql connections keyed by connection dict, holding up to maxSize connections
+    per key (checkouts wait up to wait secs for one to be released) and keeping at least 
+    minSize open; connections idle for more than ping secs are pinged on checkout, and 
+    connections idle for more than idle secs or open for more than lifetime secs are 
+    closed; after os.fork() the inherited connections are dropped (not closed)
+    """
+
+    # constructor method - set limits and initialize pool state
+    def __init__(self, minSize=0, maxSize=8, idle=300, lifetime=3600, ping=1.0, wait=30):
+        """set per-key size limits, idle, lifetime, and ping secs, and checkout wait secs,
+           and initialize pool"""
+
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.idle = idle
+        self.lifetime = lifetime
+        self.ping = ping
+        self.wait = wait
+        self.cond = threading.Condition()
+        self.reset()
+
+    # reset method - drops all pooled connections without closing them
+    def reset(self):
+        """drops all pooled connections without closing them (e.g. sockets owned by parent)"""
+
+        self.pid = os.getpid()
+        self.pools = dict()  # key -> dict(idle=list of dicts(conn, created, used), count)
+
+    # key method - returns the pool key for a connection dict
+    @staticmethod
+    def key(db):
+        """returns the pool key for connection dict db"""
+
+        return repr(sorted(db.items()))
+
+    # entries method - returns the pool for db in this process
+    def entries(self, db):
+        """returns the pool dict for db in the current process (call with cond held)"""
+
+        if self.pid != os.getpid(): self.reset()
+        return self.pools.setdefault(DbPool.key(db), {'idle': list(), 'count': 0})
+
+    # discard method - closes a connection, ignoring errors
+    @staticmethod
+    def discard(conn):
+        """closes conn, ignoring errors"""
+
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+
+    # acquire method - returns a healthy connection for db
+    def acquire(self, db):
+        """
+        returns a healthy connection for db, reusing the most recently released idle one, 
+        then opening a new one if fewer than maxSize are open, then waiting up to wait secs 
+        for one to be released; the connection must be returned with release
+        """
+
+        deadline = time.time() + self.wait
+        with self.cond:
+            pool = self.entries(db)
+            while True:
+                now = time.time()
+                # reuse an idle connection that is young enough and still alive
+                while pool['idle']:
+                    e = pool['idle'].pop()
+                    if (now - e['created'] < self.lifetime and 
+                        (now - e['used'] < self.ping or e['conn'].is_connected())):
+                        e['used'] = now
+                        return e['conn']
+                    DbPool.discard(e['conn'])
+                    pool['count'] -= 1
+                if pool['count'] < self.maxSize: break
+                if now >= deadline: 
+                    raise error('DbPool.acquire', 'error', 'connection limit reached')
+                self.cond.wait(deadline - now)
+            pool['count'] += 1
+            opened = pool['count'] == 1
+
+        # open a new connection outside the lock
+        try:
+            conn = mysql.connector.connect(**db)
+        except mysql.connector.Error:
+            with self.cond: 
+                self.entries(db)['count'] -= 1
+                self.cond.notify()
+            raise
+        conn._dbPoolCreated = time.time()
+
+        # fill the pool to minSize on first use; failures here don't fail the checkout
+        if opened:
+            try:
+                for i in range(self.minSize - 1): 
+                    self.release(db, mysql.connector.connect(**db), new=True)
+            except mysql.connector.Error:
+                pass
+        return conn
+
+    # release method - returns a connection to the pool
+    def release(self, db, conn, ok=True, new=False):
+        """
+        returns conn to the pool for reuse; pass ok=False to close a connection that may be 
+        in a bad state (e.g. after an error); connections from before a fork are ignored
+        """
+
+        with self.cond:
+            if self.pid != os.getpid(): return
+            pool = self.entries(db)
+            if new:
+                pool['count'] += 1
+                conn._dbPoolCreated = time.time()
+            now = time.time()
+            created = getattr(conn, '_dbPoolCreated', now)
+
+            # close expired connections and those idle too long beyond minSize
+            for e in list(pool['idle']):
+                if (now - e['created'] >= self.lifetime or (now - e['used'] >= self.idle and
+                                                            pool['count'] > self.minSize)):
+                    pool['idle'].remove(e)
+                    DbPool.discard(e['conn'])
+                    pool['count'] -= 1
+
+            if ok and now - created < self.lifetime:
+                pool['idle'].append({'conn': conn, 'created': created, 'used': now})
+            else:
+                DbPool.discard(conn)
+                pool['count'] -= 1
+            self.cond.notify()
+
+    # close method - closes all idle connections
+    def close(self):
+        """closes all idle connections in this process"""
+
+        with self.cond:
+            if self.pid != os.getpid(): return self.reset()
+            for pool in self.pools.values():
+                for e in pool['idle']: DbPool.discard(e['conn'])
+                pool['count'] -= len(pool['idle'])
+                pool['idle'] = list()
+
+# dbPool - process-wide connection pool used by queryMysql for connection dicts
+dbPool = DbPool()
+
+# DbCache - process-wide LRU cache of read-only query results
+class DbCache(object):
+    """
+    LRU cache of query results keyed by connection dict, normalized query, inputs, and row 
+    format, each kept for its own ttl secs and evicted least recently used first once the
+    estimated size of all results exceeds maxBytes; entries are invalidated by the table 
+    names they read (or all at once, e.g. after a CALL), and results read while one of 
+    their tables was invalidated are not stored; cached results are shared between callers
+    and must not be modified
+    """
+
+    writeRe = re.compile(r'^(?:\s+|/\*.*?\*/|(?:--\s|#)[^\n]*(?:\n|$))*' + 
+                         r'(INSERT|UPDATE|DELETE|REPLACE|TRUNCATE|ALTER|DROP|CREATE|' + 
+                         r'RENAME|LOAD|CALL)\b', re.I | re.S)
+    quotedRe = re.compile(r'(\'(?:[^\'\\]|\\.|\'\')*\'|"(?:[^"\\]|\\.|"")*"|`[^`]*`)', re.S)
+    tableRe = re.compile(r'\b(?:JOIN|INTO|UPDATE|TABLE(?:\s+IF\s+(?:NOT\s+)?EXISTS)?)\s+' +
+                         r'((?:`?\w+`?\.)?`?\w+)`?', re.I)
+    fromRe = re.compile(r'\bFROM\s+(.*?)(?=\b(?:WHERE|GROUP|ORDER|LIMIT|HAVING|UNION|JOIN|' +
+                        r'LEFT|RIGHT|INNER|OUTER|CROSS|NATURAL|STRAIGHT_JOIN|FOR|LOCK)\b|' + 
+                        r'[();]|$)', re.I | re.S)
+
+    # constructor method - set limits and initialize cache state
+    def __init__(self, maxBytes=67108864, ttl=60):
+        """set the estimated size limit and default ttl secs, and initialize cache"""
+
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.clear()
+
+    # clear method - drops all entries and resets counters
+    def clear(self):
+        """drops all cached results and resets hit, miss, and eviction counters"""
+
+        with self.lock:
+            self.entries = collections.OrderedDict()  # key -> (result, expires, size, tables)
+            self.keys = dict()                        # table -> set of keys reading it
+            self.stamps = dict()                      # table -> invalidation count
+            self.used = 0
+            (self.hits, self.misses, self.evictions) = (0, 0, 0)
+
+    # key method - returns the cache key for a query
+    @staticmethod
+    def key(db, query, inputs, form='dict'):
+        """returns the cache key for connection dict db, query, inputs, and row format"""
+
+        return (DbPool.key(db), DbCache.normalize(query), repr(sorted(inputs.items())), form)
+
+    # normalize method - collapses whitespace outside quoted strings and names
+    @staticmethod
+    def normalize(query):
+        """returns query with runs of whitespace outside quotes collapsed to one space"""
+
+        parts = DbCache.quotedRe.split(query.strip())
+        for i in range(0, len(parts), 2): parts[i] = re.sub(r'\s+', ' ', parts[i])
+        return ''.join(parts)
+
+    # tables method - returns the table names a query reads or writes
+    @staticmethod
+    def tables(query):
+        """returns the set of lower case table names (without database) named in query"""
+
+        names = DbCache.tableRe.findall(query)
+        for clause in DbCache.fromRe.findall(query): 
+            names += [t.split()[0] for t in clause.split(',') if t.strip()]
+        return set([n.replace('`', '').split('.')[-1].lower() for n in names 
+                    if re.match(r'^[\w`.]+$', n)])
+
+    # size method - estimates the memory used by a result
+    @staticmethod
+    def size(obj, depth=3):
+        """returns the estimated size of obj in bytes, sampling up to 100 items per level"""
+
+        n = sys.getsizeof(obj)
+        if depth and isinstance(obj, (list, tuple, dict)):
+            items = obj.values() if isinstance(obj, dict) else obj
+            sample = items[:100]
+            if sample: 
+                n += sum([DbCache.size(v, depth - 1) for v in sample]) * len(items) / len(sample)
+        return n
+
+    # get method - returns a cached result
+    def get(self, key):
+        """returns (True, result) if a live result is cached for key, otherwise (False, None)"""
+
+        with self.lock:
+            e = self.entries.pop(key, None)
+            if e is not None and e[1] > time.time():
+                self.entries[key] = e
+                self.hits += 1
+                return (True, e[0])
+            if e is not None: self.drop(key, e)
+            self.misses += 1
+            return (False, None)
+
+    # stamp method - returns the invalidation state of tables
+    def stamp(self, tables):
+        """returns a stamp of tables' invalidation counts to pass to put"""
+
+        with self.lock:
+            return tuple([self.stamps.get(t, 0) for t in sorted(tables) + ['*']])
+
+    # put method - caches a result
+    def put(self, key, result, tables, stamp, ttl=None):
+        """caches result for key for ttl secs (default self.ttl) unless one of tables was 
+           invalidated since stamp was taken, evicting least recently used results to fit"""
+
+        size = DbCache.size(result)
+        with self.lock:
+            if size > self.maxBytes: return
+            if tuple([self.stamps.get(t, 0) for t in sorted(tables) + ['*']]) != stamp: return
+            if key in self.entries: self.drop(key, self.entries.pop(key))
+            while self.entries and self.used + size > self.maxBytes:
+                (k, e) = self.entries.popitem(last=False)
+                self.drop(k, e)
+                self.evictions += 1
+            self.entries[key] = (result, time.time() + (ttl or self.ttl), size, tables)
+            self.used += size
+            for t in tables: self.keys.setdefault(t, set()).add(key)
+
+    # drop method - forgets a removed entry
+    def drop(self, key, e):
+        """releases the size and table references of entry e removed for key (call with 
+           lock held)"""
+
+        self.used -= e[2]
+        for t in e[3]:
+            keys = self.keys.get(t)
+            if keys is not None: 
+                keys.discard(key)
+                if not keys: del self.keys[t]
+
+    # invalidate method - drops results that read any of tables
+    def invalidate(self, tables=None):
+        """drops cached results that read any of tables (names are matched case 
+           insensitively, without database), or all results if tables is None"""
+
+        with self.lock:
+            if tables is None:
+                self.stamps['*'] = self.stamps.get('*', 0) + 1
+                for (k, e) in self.entries.items(): self.drop(k, e)
+                self.entries.clear()
+            for t in tables or ():
+                t = t.lower()
+                self.stamps[t] = self.stamps.get(t, 0) + 1
+                for k in list(self.keys.get(t, ())):
+                    if k in self.entries: self.drop(k, self.entries.pop(k))
+
+    # stats method - returns cache counters
+    def stats(self):
+        """returns a dict of hits, misses, evictions, entries, and bytes (estimated)"""
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.used}
+
+# dbCache - process-wide result cache used by queryMysql when '__cache' is set
+dbCache = DbCache()
+
+# templateMysql - expands list inputs of a query template into individual keys and anchors
+def templateMysql(query, inputs):
+    """
+    returns (query, inputs) with each list input k replaced by keys __{k}{i} and its anchor
+    %(k)s replaced by the new keys' anchors (empty lists become empty strings); rewritten 
+    queries are cached by query and list lengths
+    """
+
+    # find list inputs and their lengths
+    lists = tuple(sorted([(k, len(v)) for (k, v) in inputs.items() if type(v) == list]))
+    if not lists: return (query, inputs)
+
+    # compile the query template for these lengths, unless cached
+    template = mysqlTemplates.get((query, lists))
+    if template is None:
+        (compiled, keys) = (query, list())
+        for (k, n) in lists:
+            if not n: continue
+            # create new keys using __{oldKey}{elementNo} format and replace the old key
+            # anchor with new key anchors
+            newKeys = ['__{0}{1}'.format(k, i) for i in range(0, n)]
+            compiled = compiled.replace('%({0})s'.format(k), 
+                                        '%({0})s'.format(')s, %('.join(newKeys)))
+            keys.append((k, newKeys))
+        if len(mysqlTemplates) >= mysqlTemplatesMax: mysqlTemplates.clear()
+        template = mysqlTemplates[(query, lists)] = (compiled, keys)
+
+    # replace list inputs with generated key/value pairs (empty lists with empty strings)
+    inputs = dict(inputs)
+    for (k, n) in lists:
+        if not n: inputs[k] = ''
+    for (k, newKeys) in template[1]:
+        inputs.update(zip(newKeys, inputs.pop(k)))
+
+    return (template[0], inputs)
+
+# recordMysql - returns the record class for a set of column names
+def recordMysql(names):
+    """
+    returns a namedtuple class (tuple storage, no per-row dict) for column names, generated 
+    once per column set; names that are not valid identifiers are renamed _{index}
+    """
+
+    names = tuple(names)
+    record = mysqlRecords.get(names)
+    if record is None:
+        if len(mysqlRecords) >= mysqlTemplatesMax: mysqlRecords.clear()
+        record = mysqlRecords[names] = collections.namedtuple(
+            'MysqlRecord', [str(n) for n in names], rename=True)
+    return record
+
+# rowsMysql - converts fetched row tuples to a row format
+def rowsMysql(names, rows, form='dict'):
+    """
+    converts rows, a list of tuples with column names, to form: 'dict' returns a list of 
+    dicts; 'tuple' returns (names, rows) with one shared header; 'record' returns a list of 
+    recordMysql(names) rows; 'column' returns a dict of column name -> array.array for 
+    columns of only ints ('l') or floats ('d'), or list for other columns; 'numpy' returns
+    a dict of column name -> numpy array (numeric columns get a numeric dtype)
+    """
+
+    if form == 'dict': return [dict(zip(names, row)) for row in rows]
+    if form == 'tuple': return (tuple(names), rows)
+    if form == 'record': return map(recordMysql(names)._make, rows)
+    if form not in ('column', 'numpy'): 
+        raise error('rowsMysql', 'error', 'invalid row format {0}'.format(form))
+
+    columns = dict()
+    for (name, values) in zip(names, zip(*rows) if rows else [()] * len(names)):
+        if form == 'numpy':
+            try:
+                import numpy
+            except ImportError:
+                raise error('rowsMysql', 'error', 'numpy is required for numpy row format')
+            columns[name] = numpy.array(values)
+            continue
+        # use a typed array when every value is an int or every value is a float
+        types = set([type(v) for v in values])
+        code = 'l' if types <= set([int, long]) and types else \
+               'd' if types == set([float]) else None
+        try:
+            columns[name] = array.array(code, values) if code else list(values)
+        except OverflowError:
+            columns[name] = list(values)
+    return columns
+
 # queryMysql - executes mysql query using a query template and inputs dict, returns list;
 #              if '__debug' == True in inputs, print debug information to stdout
 def queryMysql(db, query, **inputs):
     """
     queries db using a key-based query template and inputs by key, returns list of dicts;
     if '__debug' key is set to True in inputs, query debug information will print to stdout; 
-    '__debug' is a reserved key and cannot be used in queries
+    '__rows' selects a compact row format instead of dicts (see rowsMysql); if '__cache' is
+    set to ttl secs (or True for the default) and db is a connection dict, results of a 
+    read-only query are cached in dbCache (see DbCache), and writes invalidate cached 
+    results of the tables they touch; '__debug', '__rows', and '__cache' are reserved keys
+    and cannot be used in queries
     """
 
     result = []
+    c = None
+    form = inputs.pop('__rows', 'dict')
+    cache = inputs.pop('__cache', None)
     debug = [query, str(inputs)] if '__debug' in inputs and inputs['__debug'] else None
     
     try:
@@ -69,38 +473,46 @@ def queryMysql(db, query, **inputs):
         cType = mysql.connector.connection.MySQLConnection
         if not (type(db) == dict or type(db) == cType): 
             raise error('queryMysql', 'error', 'db arg is an invalid type')
+        if form not in ('dict', 'tuple', 'record', 'column', 'numpy'):
+            raise error('queryMysql', 'error', 'invalid row format {0}'.format(form))
 
         # convert input parameters passed as a list into individual keys and anchors
-        for k in inputs.keys():
-            if type(inputs[k]) == list:
-                n = len(inputs[k])
-                # if list is empty, replace with an empty string and continue
-                if not n:
-                    inputs[k] = ''
-                    continue
-                # otherwise, create new keys using __{oldKey}{elementNo} format
-                newKeys = ['__{0}{1}'.format(k, i) for i in range(0, n)]
-                newDict = dict([(newKeys[i], inputs[k][i]) for i in range(0, n)])
-                # delete list from inputs and replace with generated key/value pairs
-                del inputs[k]
-                inputs = dict(inputs.items() + newDict.items())
-                # replace the old key anchor with new key anchors
-                query = query.replace('%({0})s'.format(k), 
-                                      '%({0})s'.format(')s, %('.join(newKeys)))
-
-        # connect to database; if db is already a mysql connection type, use that instead
-        c = mysql.connector.connect(**db) if not type(db) == cType else db
+        (query, inputs) = templateMysql(query, inputs)
+
+        # return a cached result if there is one, noting table state before reading
+        write = DbCache.writeRe.match(query) is not None
+        if cache and type(db) == dict and not write:
+            key = DbCache.key(db, query, inputs, form)
+            (hit, cached) = dbCache.get(key)
+            if hit: return cached
+            tables = DbCache.tables(query)
+            stamp = dbCache.stamp(tables)
+
+        # get a pooled connection; if db is already a mysql connection type, use that instead
+        c = dbPool.acquire(db) if not type(db) == cType else db
         cursor = c.cursor()
 
         # execute query and build result
         cursor.execute(query, inputs)
         if debug: debug.append(cursor.statement)
-        for row in cursor: result.append(dict(zip(cursor.column_names, row)))
+        if cursor.with_rows: 
+            result = rowsMysql(cursor.column_names, cursor.fetchall(), form)
 
-        # commit changes to db and close the db cursor/connection (but only if we opened it)
+        # commit changes to db, close the db cursor, and release the connection to the pool
+        # (but only if we acquired it)
         c.commit()  # this is required to write to MySQL InnoDB tables
         cursor.close()
-        if type(db) == dict: c.close()
+        if type(db) == dict: 
+            dbPool.release(db, c)
+            c = None
+
+        # invalidate cached results of tables written, or cache the result read
+        if write: 
+            # a stored procedure may write any table
+            call = DbCache.writeRe.match(query).group(1).upper() == 'CALL'
+            dbCache.invalidate(None if call else DbCache.tables(query))
+        elif cache and type(db) == dict: 
+            dbCache.put(key, result, tables, stamp, None if cache is True else cache)
 
         # if debug, print debug data and the last MySQL statement executed
         if debug: print str(debug)
@@ -113,6 +525,195 @@ def queryMysql(db, query, **inputs):
     except mysql.connector.Error as e:
         raise error('queryMysql', 'error', str(e))
 
+    # on any error, close the connection if we acquired it
+    finally:
+        if type(db) == dict and c is not None: dbPool.release(db, c, ok=False)
+
+# queryManyMysql - executes many independent queries concurrently on pooled connections
+def queryManyMysql(db, queries, threads=8, ordered=True):
+    """
+    runs queries, an iterable of (query, inputs dict) pairs, with queryMysql on up to threads
+    worker threads (at most dbPool.maxSize), each using its own pooled connection for 
+    connection dict db; returns a list of (result, error) in input order, or if ordered is 
+    False, a generator of (index, result, error) as queries complete; error is None or the 
+    exception a query raised, which does not stop the other queries
+    """
+
+    # validate db type (a single connection cannot be shared between threads)
+    if not type(db) == dict: 
+        raise error('queryManyMysql', 'error', 'db arg must be a connection dict')
+
+    queries = list(queries)
+    (tasks, done) = (Queue.Queue(), Queue.Queue())
+    for (i, (query, inputs)) in enumerate(queries): tasks.put((i, query, inputs or dict()))
+
+    # each worker runs queries until none are left, collecting errors per query
+    def work():
+        while True:
+            try:
+                (i, query, inputs) = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((i, queryMysql(db, query, **inputs), None))
+            except Exception as e:
+                done.put((i, None, e))
+
+    for n in range(min(threads, dbPool.maxSize, len(queries))):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+
+    # yield results as they complete, or gather them in input order
+    def completed():
+        for n in range(len(queries)): yield done.get()
+    if not ordered: return completed()
+    results = [None] * len(queries)
+    for (i, result, e) in completed(): results[i] = (result, e)
+    return results
+
+# streamMysql - executes mysql query using a query template and inputs, yielding rows
+def streamMysql(db, query, chunkSize=None, **inputs):
+    """
+    queries db like queryMysql, but yields each row as a dict as it is read from an 
+    unbuffered cursor, or lists of up to chunkSize row dicts if chunkSize is set, so memory
+    stays flat for any result size ('__debug' works as in queryMysql); if the 
+    consumer stops early (e.g. breaks or closes the generator), a pooled connection is 
+    closed rather than reading the remaining rows, and a caller's connection has its 
+    remaining rows discarded
+    """
+
+    debug = [query, str(inputs)] if '__debug' in inputs and inputs['__debug'] else None
+    (c, cursor, done) = (None, None, False)
+
+    try:
+
+        # validate db type
+        cType = mysql.connector.connection.MySQLConnection
+        if not (type(db) == dict or type(db) == cType): 
+            raise error('streamMysql', 'error', 'db arg is an invalid type')
+
+        # convert input parameters passed as a list into individual keys and anchors
+        (query, inputs) = templateMysql(query, inputs)
+
+        # get a pooled connection; if db is already a mysql connection type, use that instead
+        c = dbPool.acquire(db) if not type(db) == cType else db
+        cursor = c.cursor(buffered=False)
+
+        # execute query and yield rows as they arrive
+        cursor.execute(query, inputs)
+        if debug: print str(debug + [cursor.statement])
+        names = cursor.column_names
+        while True:
+            rows = cursor.fetchmany(chunkSize or 1000)
+            if not rows: break
+            rows = [dict(zip(names, row)) for row in rows]
+            if chunkSize: yield rows
+            else:
+                for row in rows: yield row
+        done = True
+
+    # catch KeyErrors when input keys dont match template and mysql errors
+    except (KeyError, IndexError) as e:
+        raise error('streamMysql', 'error', 'inputs do not match template: {0}'.format(str(e)))
+    except mysql.connector.Error as e:
+        raise error('streamMysql', 'error', str(e))
+
+    # close the cursor and release the connection (but only if we acquired it); if rows
+    # are left unread, close a pooled connection and discard the rows on a caller's
+    finally:
+        if c is not None:
+            try:
+                if not done and type(db) == cType: c.consume_results()
+                if done or type(db) == cType:
+                    c.commit()
+                    cursor.close()
+            except mysql.connector.Error:
+                done = False
+            if type(db) == dict: dbPool.release(db, c, ok=done)
+
+# insertMysql - inserts or upserts rows in multi-row statements, committing per statement
+def insertMysql(db, table, rows, columns=None, update=None, maxBytes=None):
+    """
+    inserts rows, an iterable (e.g. a generator) of dicts, into table in multi-row INSERT 
+    statements of up to maxBytes (default the lesser of max_allowed_packet and 16MB), 
+    committing after each statement; table may be a table name or a statement head, e.g. 
+    'REPLACE INTO t' or 'INSERT IGNORE INTO t'; columns default to the first row's keys; 
+    update adds ON DUPLICATE KEY UPDATE for a list of columns, or all columns if True; 
+    returns the number of rows sent
+    """
+
+    (c, count) = (None, 0)
+
+    # estimate the escaped size of a value in bytes (escaping at most doubles a string,
+    # and unicode is sent UTF-8 encoded)
+    def size(v):
+        if isinstance(v, unicode): return 2 * len(v.encode('utf8')) + 3
+        if isinstance(v, str): return 2 * len(v) + 3
+        return 6 if v is None else len(str(v)) + 3
+
+    try:
+
+        # validate db type
+        cType = mysql.connector.connection.MySQLConnection
+        if not (type(db) == dict or type(db) == cType): 
+            raise error('insertMysql', 'error', 'db arg is an invalid type')
+
+        # get a pooled connection; if db is already a mysql connection type, use that instead
+        c = dbPool.acquire(db) if not type(db) == cType else db
+        cursor = c.cursor()
+        if maxBytes is None:
+            cursor.execute('SELECT @@max_allowed_packet')
+            maxBytes = min(int(cursor.fetchall()[0][0]) - 1024, 16777216)
+
+        # build statements from the first row's columns, sending each once it is full
+        (head, tail, values, params, used) = (None, '', list(), list(), 0)
+        for row in rows:
+            if head is None:
+                columns = list(columns) if columns else sorted(row.keys())
+                head = '{0} ({1}) VALUES '.format(
+                    table if ' ' in table.strip() else 'INSERT INTO ' + table,
+                    ', '.join(['`{0}`'.format(k) for k in columns]))
+                if update:
+                    keys = columns if update is True else update
+                    tail = ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                        ['`{0}`=VALUES(`{0}`)'.format(k) for k in keys])
+                placeholder = '(' + ', '.join(['%s'] * len(columns)) + ')'
+                used = len(head) + len(tail)
+            rowValues = [row[k] for k in columns]
+            rowBytes = sum([size(v) for v in rowValues]) + len(columns) + 2
+            if values and used + rowBytes > maxBytes:
+                cursor.execute(head + ', '.join(values) + tail, params)
+                c.commit()
+                dbCache.invalidate(DbCache.tables(head))
+                (values, params, used) = (list(), list(), len(head) + len(tail))
+            values.append(placeholder)
+            params += rowValues
+            used += rowBytes
+            count += 1
+        if values:
+            cursor.execute(head + ', '.join(values) + tail, params)
+            c.commit()
+            dbCache.invalidate(DbCache.tables(head))
+
+        # close the db cursor and release the connection to the pool (if we acquired it)
+        cursor.close()
+        if type(db) == dict: 
+            dbPool.release(db, c)
+            c = None
+
+        return count
+
+    # catch KeyErrors when rows dont match columns and mysql errors
+    except KeyError as e:
+        raise error('insertMysql', 'error', 'row does not match columns: {0}'.format(str(e)))
+    except mysql.connector.Error as e:
+        raise error('insertMysql', 'error', str(e))
+
+    # on any error, close the connection if we acquired it
+    finally:
+        if type(db) == dict and c is not None: dbPool.release(db, c, ok=False)
+
 ##############################################################################################
 # TESTING #
 ##############################################################################################
@@ -137,6 +738,46 @@ def main():
     print aColor('BLUE') + 'queryMysql...', aColor('OFF'), \
         queryMysql(db, 'SELECT * FROM devtest WHERE id=%(id)s', id=20)
 
+    # insertMysql test
+    rows = ({'a': i, 'b': 'bulk index was {0}'.format(i)} for i in range(10000))
+    print aColor('BLUE') + 'insertMysql...', aColor('OFF'), \
+        insertMysql(db, 'devtest', rows, maxBytes=65536), \
+        insertMysql(db, 'devtest', [{'id': 20, 'a': 1, 'b': 'upserted'}], update=['b']), \
+        queryMysql(db, 'SELECT * FROM devtest WHERE id=%(id)s', id=20)
+
+    # queryManyMysql test
+    print aColor('BLUE') + 'queryManyMysql...', aColor('OFF'), \
+        queryManyMysql(db, [('SELECT id FROM devtest WHERE id=%(id)s', {'id': i}) 
+                            for i in range(1, 5)] + [('SELECT bad FROM devtest', None)])
+
+    # streamMysql test
+    print aColor('BLUE') + 'streamMysql...', aColor('OFF'), \
+        sum([len(rows) for rows in streamMysql(db, 'SELECT * FROM devtest', chunkSize=8)]), \
+        streamMysql(db, 'SELECT * FROM devtest WHERE id IN (%(ids)s)', ids=[1, 2]).next()
+
+    # rowsMysql test
+    print aColor('BLUE') + 'rowsMysql...', aColor('OFF'), \
+        queryMysql(db, 'SELECT id, b FROM devtest WHERE id<3', __rows='tuple'), \
+        queryMysql(db, 'SELECT id, b FROM devtest WHERE id<3', __rows='record'), \
+        queryMysql(db, 'SELECT id, a FROM devtest WHERE id<5', __rows='column')
+
+    # dbCache test
+    for i in range(0, 3):
+        queryMysql(db, 'SELECT * FROM devtest WHERE id=%(id)s', id=20, __cache=10)
+    queryMysql(db, 'UPDATE devtest SET b=%(b)s WHERE id=%(id)s', b='cached', id=20)
+    print aColor('BLUE') + 'dbCache...', aColor('OFF'), \
+        queryMysql(db, 'SELECT * FROM devtest WHERE id=%(id)s', id=20, __cache=10), \
+        dbCache.stats()
+
+    # templateMysql test
+    print aColor('BLUE') + 'templateMysql...', aColor('OFF'), \
+        queryMysql(db, 'SELECT id FROM devtest WHERE id IN (%(ids)s)', ids=[1, 2, 3]), \
+        templateMysql('IN (%(ids)s)', {'ids': [1, 2, 3]})
+
+    # dbPool test
+    print aColor('BLUE') + 'dbPool...', aColor('OFF'), \
+        dbPool.pools[DbPool.key(db)]['count'], len(dbPool.pools[DbPool.key(db)]['idle'])
+
 if __name__ == '__main__':
 
     try:
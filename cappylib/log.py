@@ -33,7 +33,8 @@
 # IMPORTS 
 ##############################################################################################
 
-import socket, os, datetime
+import pika, socket, os, sys, datetime, calendar, time, atexit, threading, Queue, array
+import bisect, struct, mmap, marshal, weakref, fcntl, heapq
 from cappylib.general import *
 from cappylib.amqp import *
 
@@ -41,10 +42,543 @@ from cappylib.amqp import *
 # GLOBAL VARS 
 ##############################################################################################
 
+logRegistry = weakref.WeakSet()  # live Log objects, flushed at exit by logFlushAll
+logSinks = weakref.WeakSet()     # live buffered sinks, flushed on time by logFlusher
+logFlusher = None                # thread running logTick in this process
+logFlushLock = threading.Lock()
+logStopping = threading.Event()  # set at exit to stop logFlusher
+
 ##############################################################################################
 # MAIN CODE
 ##############################################################################################
 
+# logTick - flushes buffered sinks whose flush interval has passed
+def logTick(period=0.1):
+    """calls tick on every live sink every period secs, so buffered events are written 
+       within their sink's flushInterval even if no more events are logged, until 
+       logStopping is set at exit"""
+
+    while not logStopping.wait(period):
+        for sink in list(logSinks):
+            try:
+                sink.tick()
+            except Exception as e:
+                sys.stderr.write('Log: {0!r}{1}'.format(e, os.linesep))
+
+# logWatch - registers a sink for timed flushes
+def logWatch(sink):
+    """adds sink to logSinks, starting the logTick thread in this process if required"""
+
+    global logFlusher
+    logSinks.add(sink)
+    with logFlushLock:
+        if logFlusher is not None and logFlusher.is_alive(): return
+        logFlusher = threading.Thread(target=logTick)
+        logFlusher.daemon = True
+        logFlusher.start()
+
+# LogFile - buffered log file sink that stays open and rotates by size or time
+class LogFile(object):
+    """
+    log file sink that keeps fileName open in append mode and buffers lines until 
+    bufferSize bytes are buffered, flushInterval secs have passed (checked by logTick 
+    between writes), or a CRITICAL or ERROR line is written; rotates to fileName.1 ... fileName.<backups> after rotateBytes bytes
+    or rotateSecs secs (if set), flushing first so no lines are dropped; reopens the file 
+    after it is rotated by another process, and after os.fork() (the child drops lines 
+    buffered by the parent, which the parent writes); writes are thread safe
+    """
+
+    # constructor method - set buffering and rotation and open the file
+    def __init__(self, level, fileName, bufferSize=65536, flushInterval=1.0, 
+                 rotateBytes=None, rotateSecs=None, backups=5):
+        """set level, buffering, and rotation and open fileName"""
+
+        self.level = level
+        self.fileName = fileName
+        self.bufferSize = bufferSize
+        self.flushInterval = flushInterval
+        self.rotateBytes = rotateBytes
+        self.rotateSecs = rotateSecs
+        self.backups = backups
+        self.fd = None
+        self.lock = threading.RLock()
+        self.open()
+        logWatch(self)
+
+    # open method - opens the file and resets the buffer
+    def open(self):
+        """opens the file for appending and resets the buffer"""
+
+        if self.fd is not None: os.close(self.fd)
+        self.fd = os.open(self.fileName, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.pid = os.getpid()
+        self.buffer = list()
+        self.buffered = 0
+        self.flushed = time.time()
+        self.opened = time.time()
+
+    # forked method - reopens the file in a forked child
+    def forked(self):
+        """after os.fork(), replaces the lock (another thread may have held it) and 
+           reopens the file; returns True if this is a forked child"""
+
+        if self.pid == os.getpid(): return False
+        self.lock = threading.RLock()
+        with self.lock: self.open()
+        logWatch(self)  # the parent's logTick thread did not survive the fork
+        return True
+
+    # write method - buffers a line and flushes if required
+    def write(self, logLevel, event, t=None):
+        """buffers event as a line; flushes on CRITICAL/ERROR or when a limit is reached"""
+
+        self.forked()
+        with self.lock:
+            self.buffer.append(event + '\n')
+            self.buffered += len(event) + 1
+            if (int(logLevel) <= Log.levels.ERROR or self.buffered >= self.bufferSize or
+                time.time() - self.flushed >= self.flushInterval): self.flush()
+
+    # tick method - flushes buffered lines once flushInterval has passed
+    def tick(self):
+        """flushes buffered lines if flushInterval secs have passed since the last flush
+           (called by logTick; lines a forked child inherited are left to the parent)"""
+
+        if self.pid != os.getpid(): return
+        with self.lock:
+            if self.buffer and time.time() - self.flushed >= self.flushInterval: self.flush()
+
+    # flush method - writes buffered lines and rotates the file if required
+    def flush(self):
+        """writes buffered lines to the file and rotates it if required"""
+
+        self.forked()
+        with self.lock:
+            if self.fd is None: return
+            if self.buffer:
+                data = ''.join(self.buffer)
+                while data: data = data[os.write(self.fd, data):]
+                (self.buffer, self.buffered) = (list(), 0)
+            self.flushed = time.time()
+            self.rotate()
+
+    # rotate method - rotates the file if a limit is reached
+    def rotate(self):
+        """rotates the file by size or age, or reopens it if another process rotated it"""
+
+        try:
+            st = os.stat(self.fileName)
+        except OSError:
+            return self.open()
+        if (st.st_ino, st.st_dev) != os.fstat(self.fd)[1:3]: return self.open()
+
+        if ((self.rotateBytes is not None and st.st_size >= self.rotateBytes) or
+            (self.rotateSecs is not None and time.time() - self.opened >= self.rotateSecs)):
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists('{0}.{1}'.format(self.fileName, i)):
+                    os.rename('{0}.{1}'.format(self.fileName, i), 
+                              '{0}.{1}'.format(self.fileName, i + 1))
+            if self.backups: os.rename(self.fileName, self.fileName + '.1')
+            else: os.remove(self.fileName)
+            self.open()
+
+    # close method - flushes and closes the file
+    def close(self):
+        """flushes buffered lines and closes the file"""
+
+        with self.lock:
+            if self.fd is None: return
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
+
+# LogBinary - binary log file sink with fixed record headers and a sparse time index
+class LogBinary(LogFile):
+    """
+    binary log file sink writing records of a fixed header (time, level, pid, length) and 
+    the formatted event, buffered like LogFile (without rotation); every indexEvery 
+    records, the record's (time, offset) is appended to a sparse index in fileName.idx so 
+    LogReader can find a time range with a binary search; each flush holds an exclusive 
+    flock on the log, so processes sharing the file (e.g. forked children) never split 
+    another's records or index offsets
+    """
+
+    HEADER = struct.Struct('<dBII')   # time, logLevel, pid, event length
+    INDEX = struct.Struct('<dQ')      # time, record offset
+
+    # constructor method - set buffering and index interval and open the files
+    def __init__(self, level, fileName, bufferSize=65536, flushInterval=1.0, 
+                 indexEvery=1000):
+        """set level, buffering, and index interval and open fileName and its index"""
+
+        self.indexEvery = indexEvery
+        self.indexFd = None
+        self.count = 0
+        LogFile.__init__(self, level, fileName, bufferSize, flushInterval)
+
+    # open method - opens the log and index files and resets the buffers
+    def open(self):
+        """opens the log and index files for appending and resets the buffers"""
+
+        LogFile.open(self)
+        if self.indexFd is not None: os.close(self.indexFd)
+        self.indexFd = os.open(self.fileName + '.idx', 
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.index = list()   # (time, offset in buffer) of records to index
+
+    # write method - buffers a record and flushes if required
+    def write(self, logLevel, event, t=None):
+        """buffers a record for event; flushes on CRITICAL/ERROR or when a limit is 
+           reached"""
+
+        self.forked()
+        t = time.time() if t is None else t
+        with self.lock:
+            if not self.count % self.indexEvery: self.index.append((t, self.buffered))
+            self.count += 1
+            record = LogBinary.HEADER.pack(t, int(logLevel), self.pid, len(event)) + event
+            self.buffer.append(record)
+            self.buffered += len(record)
+            if (int(logLevel) <= Log.levels.ERROR or self.buffered >= self.bufferSize or
+                time.time() - self.flushed >= self.flushInterval): self.flush()
+
+    # flush method - writes buffered records and index entries
+    def flush(self):
+        """writes buffered records, then their index entries, holding an exclusive lock on
+           the log so the records' offsets are where they land"""
+
+        self.forked()
+        with self.lock:
+            if self.fd is None: return
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                base = os.fstat(self.fd).st_size
+                index = ''.join([LogBinary.INDEX.pack(t, base + o) for (t, o) in self.index])
+                LogFile.flush(self)
+                while index: index = index[os.write(self.indexFd, index):]
+                self.index = list()
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    # rotate method - binary logs are not rotated
+    def rotate(self):
+        """binary logs are not rotated"""
+
+        pass
+
+    # close method - flushes and closes the log and index files
+    def close(self):
+        """flushes and closes the log and index files"""
+
+        with self.lock:
+            if self.fd is None: return
+            LogFile.close(self)
+            os.close(self.indexFd)
+            self.indexFd = None
+
+# LogReader - memory-mapped reader of LogBinary files
+class LogReader(object):
+    """
+    reader of LogBinary files that memory-maps the log and binary searches its sparse 
+    time index to find records between two times without scanning the whole file
+    """
+
+    # constructor method - map the log file and load its index
+    def __init__(self, fileName):
+        """map fileName and load its sparse time index"""
+
+        self.fileName = fileName
+        with open(fileName, 'rb') as fh:
+            self.size = os.fstat(fh.fileno()).st_size
+            self.mm = mmap.mmap(fh.fileno(), self.size, access=mmap.ACCESS_READ) \
+                if self.size else ''
+        (self.times, self.offsets) = (list(), list())
+        if os.path.exists(fileName + '.idx'):
+            with open(fileName + '.idx', 'rb') as fh: data = fh.read()
+            n = LogBinary.INDEX.size
+            for i in range(0, len(data) - n + 1, n):
+                (t, offset) = LogBinary.INDEX.unpack_from(data, i)
+                self.times.append(t)
+                self.offsets.append(offset)
+
+    # query method - yields records between two times at or above a severity
+    def query(self, t1=None, t2=None, logLevel=None, slack=60.0):
+        """
+        yields (time, logLevel, pid, event) records with t1 <= time <= t2 (either may be 
+        None) at logLevel or more severe (numerically lower, e.g. ERROR includes CRITICAL);
+        records from several processes are only roughly in time order, so the scan starts
+        at the last indexed record before t1 - slack and stops at the first record after 
+        t2 + slack secs
+        """
+
+        i = bisect.bisect_left(self.times, t1 - slack) if t1 is not None else 0
+        pos = self.offsets[i - 1] if i > 0 else 0
+        n = LogBinary.HEADER.size
+        while pos + n <= self.size:
+            (t, level, pid, length) = LogBinary.HEADER.unpack_from(self.mm, pos)
+            if t2 is not None and t > t2 + slack: break
+            if ((t1 is None or t >= t1) and (t2 is None or t <= t2) and 
+                (logLevel is None or level <= int(logLevel))):
+                yield (t, level, pid, self.mm[pos + n:pos + n + length])
+            pos += n + length
+
+    # close method - unmaps the log file
+    def close(self):
+        """unmaps the log file"""
+
+        if self.size: self.mm.close()
+
+# logExport - command-line export of a LogBinary file to text
+def logExport():
+    """
+    exports LogBinary file --export=<fileName> to stdout as text, optionally limited to 
+    --since=<time> and --until=<time> (secs since the epoch or UTC 'YYYY-MM-DDTHH:MM:SS') 
+    and --level=<name or number> or more severe; e.g.
+    python -m cappylib.log --export=app.blog --since=2014-01-02T09:30:00 --level=ERROR
+    """
+
+    def parseTime(value):
+        if not value: return None
+        try:
+            return float(value)
+        except ValueError:
+            dt = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+            return float(calendar.timegm(dt.timetuple()))
+
+    args = argParse(keyMap=[])
+    level = args.get('level')
+    if level and not level.isdigit(): level = Log.levels.NAMES.index(level.upper())
+    reader = LogReader(args['export'])
+    for record in reader.query(parseTime(args.get('since')), parseTime(args.get('until')),
+                               None if level in (None, '') else int(level)):
+        sys.stdout.write(record[3] + os.linesep)
+    reader.close()
+
+# LogAmqp - amqp log sink that publishes buffered events in batches on one connection
+class LogAmqp(object):
+    """
+    amqp log sink that keeps one connection open and publishes buffered events in 
+    confirmed batches when bufferSize events are buffered, flushInterval secs have passed
+    (checked by logTick between writes), or a CRITICAL or ERROR event is written; events go to exchange with routing key 
+    key.format(level=levelName); if the broker is unavailable, events stay buffered (up 
+    to maxBuffer, oldest dropped first) and publishing is retried every retry secs, so 
+    write and flush never raise
+    """
+
+    # constructor method - set exchange, key, buffering, and retry
+    def __init__(self, level, amqp, exchange, key='', bufferSize=100, flushInterval=1.0, 
+                 maxBuffer=10000, retry=5.0):
+        """set level, amqp config, exchange dict, routing key template, buffering, and 
+           retry"""
+
+        self.level = level
+        self.config = dict(amqp.items() + [('persistent', True), ('pooled', False)])
+        self.exchange = exchange
+        self.key = key
+        self.bufferSize = bufferSize
+        self.flushInterval = flushInterval
+        self.maxBuffer = maxBuffer
+        self.retry = retry
+        self.pid = None
+        self.dropped = 0       # events dropped while the broker was unavailable
+        self.failures = 0      # failed publish attempts
+        self.lock = threading.RLock()
+        self.open()
+        logWatch(self)
+
+    # open method - resets the connection and buffer
+    def open(self):
+        """resets the connection (connecting lazily) and the buffer"""
+
+        self.amqp = Amqp(self.config)
+        self.pid = os.getpid()
+        self.buffer = list()
+        self.flushed = time.time()
+        self.retryAt = 0
+
+    # forked method - resets the connection in a forked child
+    def forked(self):
+        """after os.fork(), replaces the lock (another thread may have held it) and resets
+           the connection and buffer; returns True if this is a forked child"""
+
+        if self.pid == os.getpid(): return False
+        self.lock = threading.RLock()
+        with self.lock: self.open()
+        logWatch(self)  # the parent's logTick thread did not survive the fork
+        return True
+
+    # write method - buffers an event and flushes if required
+    def write(self, logLevel, event, t=None):
+        """buffers event; flushes on CRITICAL/ERROR or when a limit is reached"""
+
+        self.forked()
+        key = self.key.format(level=Log.levels.NAMES[logLevel]) if self.key else ''
+        with self.lock:
+            self.buffer.append((self.exchange, key, event))
+            if len(self.buffer) > self.maxBuffer:
+                self.dropped += len(self.buffer) - self.maxBuffer
+                del self.buffer[:len(self.buffer) - self.maxBuffer]
+            if (int(logLevel) <= Log.levels.ERROR or len(self.buffer) >= self.bufferSize or
+                time.time() - self.flushed >= self.flushInterval): self.flush()
+
+    # tick method - flushes buffered events once flushInterval has passed
+    def tick(self):
+        """flushes buffered events if flushInterval secs have passed since the last flush
+           (called by logTick; events a forked child inherited are left to the parent)"""
+
+        if self.pid != os.getpid(): return
+        with self.lock:
+            if self.buffer and time.time() - self.flushed >= self.flushInterval: self.flush()
+
+    # flush method - publishes buffered events unless waiting to retry
+    def flush(self):
+        """publishes buffered events in a confirmed batch; on failure (including a closed
+           confirm channel or a wholly nacked batch, e.g. after the exchange was deleted) 
+           keeps them buffered, drops cached declarations, reconnects, and waits retry 
+           secs before trying again"""
+
+        self.forked()
+        with self.lock: self.send()
+
+    # send method - publishes buffered events (assumes lock)
+    def send(self):
+        """publishes buffered events unless waiting to retry (see flush)"""
+
+        self.flushed = time.time()
+        if not self.buffer or time.time() < self.retryAt: return
+
+        try:
+            (batch, nacked) = (self.buffer, self.amqp.publishBatch(self.buffer))
+            self.buffer = list(nacked)
+            confirms = self.amqp.confirms
+            if not nacked or (len(nacked) < len(batch) and confirms is not None and 
+                              confirms.channel.is_open): return
+        except (error, pika.exceptions.AMQPError, socket.error):
+            pass
+
+        self.failures += 1
+        self.retryAt = time.time() + self.retry
+        amqpTopology.invalidate(self.amqp.key)
+        try:
+            self.amqp.close()
+        except (error, pika.exceptions.AMQPError, socket.error):
+            pass
+        self.amqp = Amqp(self.config)
+
+    # close method - flushes and closes the connection
+    def close(self):
+        """flushes buffered events and closes the connection"""
+
+        self.forked()
+        with self.lock:
+            self.retryAt = 0
+            self.send()
+            try:
+                self.amqp.close()
+            except (error, pika.exceptions.AMQPError, socket.error):
+                pass
+
+# LogEvents - bounded in-memory event log with per-level and time indexes
+class LogEvents(object):
+    """
+    bounded in-memory log of (logLevel, time, event) records kept as parallel arrays of 
+    levels, times, and offsets into a string arena, with per-level indexes (unicode events
+    are stored UTF-8 encoded and read back as unicode); the oldest records are evicted 
+    once there are more than maxEvents records or maxBytes bytes of event text, and 
+    records can be read back by last n, level, or time
+    """
+
+    UNICODE = 0x80  # level flag for records whose event was unicode
+
+    # constructor method - set limits and initialize arrays and indexes
+    def __init__(self, maxEvents=10000, maxBytes=4194304):
+        """set record limits and initialize arrays, arena, and indexes"""
+
+        self.maxEvents = maxEvents
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.levels = array.array('B')
+        self.times = array.array('d')
+        self.offsets = array.array('L')  # arena offset of each record's event
+        self.arena = bytearray()
+        self.start = 0                   # array index of the oldest live record
+        self.first = 0                   # sequence number of the oldest live record
+        self.index = dict([(l, array.array('L')) for l in range(len(Log.levels.NAMES))])
+
+    # __len__ method - returns the number of live records
+    def __len__(self):
+        return len(self.levels) - self.start
+
+    # append method - adds a record, evicting the oldest records if required
+    def append(self, logLevel, t, event):
+        """adds a (logLevel, time, event) record, evicting the oldest records if a limit 
+           is exceeded"""
+
+        with self.lock:
+            self.index[int(logLevel)].append(self.first + len(self))
+            self.levels.append(int(logLevel) | (LogEvents.UNICODE if type(event) == unicode 
+                                                else 0))
+            self.times.append(t)
+            self.offsets.append(len(self.arena))
+            self.arena += event.encode('utf8') if type(event) == unicode else event
+
+            # evict the oldest records while a limit is exceeded
+            while len(self) > 1 and (len(self) > self.maxEvents or 
+                                     len(self.arena) - self.offsets[self.start] > 
+                                     self.maxBytes):
+                (self.start, self.first) = (self.start + 1, self.first + 1)
+
+            # compact once more than half of the arrays are evicted records
+            if self.start > len(self.levels) // 2: self.compact()
+
+    # compact method - drops evicted records from the arrays, arena, and indexes
+    def compact(self):
+        """drops evicted records from the arrays, arena, and indexes"""
+
+        base = self.offsets[self.start]
+        self.levels = self.levels[self.start:]
+        self.times = self.times[self.start:]
+        self.offsets = array.array('L', [o - base for o in self.offsets[self.start:]])
+        self.arena = self.arena[base:]
+        self.start = 0
+        for l in self.index:
+            self.index[l] = self.index[l][bisect.bisect_left(self.index[l], self.first):]
+
+    # record method - returns the record for array index i (assumes lock)
+    def record(self, i):
+        """returns the (logLevel, time, event) record at array index i"""
+
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.arena)
+        event = str(self.arena[self.offsets[i]:end])
+        if self.levels[i] & LogEvents.UNICODE: event = event.decode('utf8')
+        return (self.levels[i] & ~LogEvents.UNICODE, self.times[i], event)
+
+    # last method - returns the last n records
+    def last(self, n=10):
+        """returns the last n (logLevel, time, event) records, oldest first"""
+
+        with self.lock:
+            return [self.record(i) for i in range(max(self.start, len(self.levels) - n),
+                                                  len(self.levels))]
+
+    # level method - returns the last n records at a log level
+    def level(self, logLevel, n=None):
+        """returns the last n (or all) live records at logLevel, oldest first"""
+
+        with self.lock:
+            idx = self.index[int(logLevel)]
+            lo = bisect.bisect_left(idx, self.first)
+            if n is not None: lo = max(lo, len(idx) - n)
+            return [self.record(seq - self.first + self.start) for seq in idx[lo:]]
+
+    # since method - returns the records logged at or after a time
+    def since(self, t):
+        """returns the live records logged at or after time t (secs since the epoch)"""
+
+        with self.lock:
+            lo = bisect.bisect_left(self.times, t, self.start)
+            return [self.record(i) for i in range(lo, len(self.levels))]
+
 # log class - simple internal logging class; supports output to other media
 class Log:
 
@@ -65,11 +599,48 @@ class Log:
         'logLevel': levels.DEBUG,
         'logStdout': levels.NONE,
         'logAmqp': None,  # dict of amqp info (amqpUser, amqpPass, etc.)
-        'logFile': None   # list of tuples (logLevel, fileName)
+        'amqpLevel': levels.DEBUG,  # highest level sent to amqp
+        'amqpExchange': {'exchange': 'Ex', 'exchange_type': 'fanout', 'passive': False, 
+                         'durable': False, 'auto_delete': True, 'nowait': False},
+        'amqpKey': '',           # routing key template, e.g. 'log.{level}'
+        'amqpBuffer': 100,       # events buffered per amqp batch
+        'amqpFlush': 1.0,        # secs between amqp flushes
+        'amqpRetry': 5.0,        # secs between attempts while the broker is unavailable
+        'logFile': None,  # list of tuples (logLevel, fileName)
+        'logBinary': None,       # list of tuples (logLevel, fileName) of LogBinary files
+        'binaryIndexEvery': 1000,  # records between binary log index entries
+        'fileBuffer': 65536,     # bytes buffered per log file
+        'fileFlush': 1.0,        # secs between log file flushes
+        'fileRotateBytes': None, # rotate log files at this size (None disables)
+        'fileRotateSecs': None,  # rotate log files at this age (None disables)
+        'fileBackups': 5,        # rotated log files kept
+        'eventMax': 10000,       # max events kept in the internal event log
+        'eventBytes': 4194304,   # max bytes of event text kept in the internal event log
+        'logAsync': False,       # write events on a background thread
+        'queueSize': 10000,      # max events queued in async mode
+        'queuePolicy': 'block',  # when the queue is full: block, dropOldest, or dropNew
+        'aggregateBuffer': 32768, # bytes of events forked children batch per collector send
+        'aggregateDelay': 2.0    # secs collected events are held to merge them in time order
         }
     __ID = ''
-    __template = ''
-    __eventLog = None     # list of tuples (logLevel, event)
+    __template = ''       # log template prefix (' host pid ID (')
+    __templatePid = None  # pid the log template prefix was created for
+    __second = None       # second the cached timestamp string is for
+    __stamp = ''          # cached timestamp string (to the second)
+    __maxLevel = 0        # highest log level any sink logs
+    __eventLog = None     # LogEvents of (logLevel, time, event) records
+    __sinks = None        # list of LogFile and LogAmqp sinks
+    __queue = None        # queue of (logLevel, event, time) tuples in async mode
+    __writer = None       # background writer thread in async mode
+    __pid = None          # pid that started the writer thread
+    __dropped = 0         # events dropped in async mode
+    __tag = None          # tag added to the ID in a forked child (e.g. an action name)
+    __inlet = None        # collector socket the parent receives child events on
+    __outlet = None       # collector socket forked children send events on
+    __collector = None    # collector thread in the parent
+    __outbox = None       # (logLevel, event, time) tuples a forked child has yet to send
+    __outboxBytes = 0     # bytes of event text in the outbox
+    __sent = 0            # time a forked child last sent its outbox
 
     # constructor method - import settings and create log template string
     def __init__(self, ID, **settings):
@@ -81,45 +652,479 @@ class Log:
         self.__ID = ID
         if self.__settings['logAmqp'] is None: self.__settings['logAmqp'] = dict()
         if self.__settings['logFile'] is None: self.__settings['logFile'] = list()
-        self.__eventLog = list() 
+        self.__eventLog = LogEvents(self.__settings['eventMax'], self.__settings['eventBytes'])
 
-    # logEvent method - generates a log entry
-    def logEvent(self, logLevel, event):
+        # open log file sinks
+        self.__sinks = [LogFile(fileLevel, fileName, self.__settings['fileBuffer'],
+                                self.__settings['fileFlush'], 
+                                self.__settings['fileRotateBytes'], 
+                                self.__settings['fileRotateSecs'], 
+                                self.__settings['fileBackups'])
+                        for (fileLevel, fileName) in self.__settings['logFile']]
+        self.__sinks += [LogBinary(fileLevel, fileName, self.__settings['fileBuffer'],
+                                   self.__settings['fileFlush'], 
+                                   self.__settings['binaryIndexEvery'])
+                         for (fileLevel, fileName) in self.__settings['logBinary'] or []]
 
-        # create log template string
-        logTemplate = '' if not self.__template else self.__template
-        if not logTemplate:
-            logTemplate = ' '.join(['{0}', socket.gethostname(), str(os.getpid()), 
-                                    self.__ID, '({1}): {2}'])
+        # open amqp sink, if enabled
+        if self.__settings['logAmqp']:
+            self.__sinks.append(LogAmqp(self.__settings['amqpLevel'], 
+                                        self.__settings['logAmqp'],
+                                        self.__settings['amqpExchange'],
+                                        self.__settings['amqpKey'],
+                                        self.__settings['amqpBuffer'],
+                                        self.__settings['amqpFlush'],
+                                        retry=self.__settings['amqpRetry']))
 
-        # apply template to event message
-        d_t = datetime.datetime
-        dt = d_t.utcnow() if self.__settings['utc'] else d_t.now()
-        levelName = Log.levels.NAMES[logLevel]
-        event = logTemplate.format(dt.isoformat(), levelName, event)
+        # flush sinks at exit (without keeping this log alive until then)
+        logRegistry.add(self)
 
-        # save event to internal log if meets logLevel requirement
-        if int(logLevel) <= int(self.__settings['logLevel']): 
-            self.__eventLog.append((logLevel, event))
+        # compute the highest log level any sink logs
+        levels = [self.__settings['logLevel'], self.__settings['logStdout']] + \
+            [f.level for f in self.__sinks]
+        self.__maxLevel = max([int(l) for l in levels])
+
+    # __start method - starts the background writer thread (private)
+    def __start(self):
+        """starts the background writer thread with an empty queue (private)"""
+
+        self.__pid = os.getpid()
+        self.__queue = Queue.Queue(self.__settings['queueSize'])
+        self.__writer = threading.Thread(target=self.__write)
+        self.__writer.daemon = True
+        self.__writer.start()
+
+    # __write method - writes queued events in batches (private)
+    def __write(self):
+        """writes queued events to the sinks in batches until a None event is queued, 
+           flushing log files whenever the queue is empty (private)"""
+
+        q = self.__queue
+        while True:
+            batch = [q.get()]
+            try:
+                while len(batch) < 1024: batch.append(q.get_nowait())
+            except Queue.Empty:
+                pass
+            # report any error and keep draining, so logEvent never blocks on a dead writer
+            for item in batch:
+                try:
+                    if item is not None: self.__dispatch(*item)
+                except Exception as e:
+                    sys.stderr.write('Log: {0!r}{1}'.format(e, os.linesep))
+            try:
+                if q.empty() or None in batch:
+                    for f in self.__sinks: f.flush()
+            except Exception as e:
+                sys.stderr.write('Log: {0!r}{1}'.format(e, os.linesep))
+            for item in batch: q.task_done()
+            if None in batch: return
+
+    # __enqueue method - queues an event for the writer thread (private)
+    def __enqueue(self, logLevel, event, t):
+        """queues an event for the writer thread, applying the queue policy (private)"""
+
+        # after a fork, start a writer for this process (the parent writes its own queue)
+        if self.__pid != os.getpid(): self.__start()
+
+        policy = self.__settings['queuePolicy']
+        try:
+            self.__queue.put((logLevel, event, t), policy == 'block')
+        except Queue.Full:
+            if policy != 'dropOldest':
+                self.__dropped += 1
+                return
+            # drop the oldest queued event to make room for this one
+            try:
+                self.__queue.get_nowait()
+                self.__queue.task_done()
+                self.__dropped += 1
+            except Queue.Empty:
+                pass
+            try:
+                self.__queue.put_nowait((logLevel, event, t))
+            except Queue.Full:
+                self.__dropped += 1
+
+    # __dispatch method - writes an event to stdout, log files, and amqp (private)
+    def __dispatch(self, logLevel, event, t=None):
+        """writes an event to stdout, log files, and amqp per their log levels (private)"""
 
         # print event to stdout, if enabled and meets logLevel requirement
         if int(logLevel) <= int(self.__settings['logStdout']): print event
         
-        # save event in logFiles, if any
-        for (fileLevel, file) in self.__settings['logFile']:
-            if int(logLevel) <= int(fileLevel):
-                with open(file, "a") as fh:
-                    fh.write(event + '\n')
+        # save event in logFiles and send it to amqp, if enabled
+        for f in self.__sinks:
+            if int(logLevel) <= int(f.level): f.write(logLevel, event, t)
 
-        # send event to amqp server, if enabled
-        if self.__settings['logAmqp']:
-            ex = {'exchange': 'Ex', 'exchange_type': 'fanout', 'passive': False, 
-                  'durable': False, 'auto_delete': True, 'nowait': False}
-            Amqp(self.__settings['logAmqp']).publish(ex, event, '')
+    # __collect method - writes events sent by forked children (private)
+    def __collect(self):
+        """receives batches of events from forked children and holds them for 
+           aggregateDelay secs, so events from children that send at different times are 
+           merged in time order onto the writer thread's queue; when an empty batch is 
+           received, writes all held events and returns (private)"""
+
+        size = 4 * self.__settings['aggregateBuffer']
+        delay = self.__settings['aggregateDelay']
+        (held, seq, done) = (list(), 0, False)  # held is a heap of (time, seq, level, event)
+        self.__inlet.settimeout(0.1)
+        while True:
+            batches = list()
+            try:
+                batches.append(self.__inlet.recv(size))
+                while batches[-1] and len(batches) < 256:
+                    batches.append(self.__inlet.recv(size, socket.MSG_DONTWAIT))
+            except socket.error:
+                pass
+            for data in batches:
+                if not data: 
+                    done = True
+                    continue
+                for (logLevel, event, t) in marshal.loads(data):
+                    heapq.heappush(held, (t, seq, logLevel, event))
+                    seq += 1
+
+            # write events held for at least delay secs (all of them once done)
+            cutoff = time.time() - delay
+            while held and (done or held[0][0] <= cutoff):
+                (t, n, logLevel, event) = heapq.heappop(held)
+                if int(logLevel) <= int(self.__settings['logLevel']): 
+                    self.__eventLog.append(logLevel, t, event)
+                self.__enqueue(logLevel, event, t)
+            if done: return
+
+    # __post method - adds an event to a forked child's outbox (private)
+    def __post(self, logLevel, event, t):
+        """adds an event to the outbox, sending it to the collector on CRITICAL/ERROR or 
+           when a limit is reached; events too big to send are written directly (private)"""
+
+        if len(event) > self.__settings['aggregateBuffer']: 
+            return self.__dispatch(logLevel, event, t)
+        if self.__outboxBytes + len(event) > self.__settings['aggregateBuffer']: self.__send()
+        self.__outbox.append((logLevel, event, t))
+        self.__outboxBytes += len(event)
+        if (int(logLevel) <= Log.levels.ERROR or 
+            time.time() - self.__sent >= self.__settings['fileFlush']): self.__send()
+
+    # __send method - sends a forked child's outbox to the collector (private)
+    def __send(self):
+        """sends the outbox to the collector as one batch; if the collector is gone, 
+           writes the events directly (private)"""
+
+        self.__sent = time.time()
+        if not self.__outbox: return
+        (batch, self.__outbox, self.__outboxBytes) = (self.__outbox, list(), 0)
+        try:
+            self.__outlet.send(marshal.dumps(batch))
+        except socket.error:
+            for item in batch: self.__dispatch(*item)
+
+    # collect method - starts collecting events from forked children
+    def collect(self):
+        """
+        starts a collector thread that writes events sent by children forked after this 
+        call (see forked) as one stream ordered by time (events sent more than 
+        aggregateDelay secs late are written as they arrive); switches this log to async mode so the 
+        writer thread batches collected and local events to the sinks
+        """
+
+        if self.__collector is not None and self.__collector.is_alive(): return
+        (self.__inlet, self.__outlet) = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.__settings['logAsync'] = True
+        if self.__pid != os.getpid(): self.__start()
+        self.__collector = threading.Thread(target=self.__collect)
+        self.__collector.daemon = True
+        self.__collector.start()
+
+    # forked method - sends a forked child's events to the parent's collector
+    def forked(self, tag=None):
+        """
+        called in a child forked after collect: tags the ID with tag (e.g. an action name)
+        and sends events in batches to the parent's collector instead of writing the sinks
+        """
+
+        if self.__outlet is None: return
+        self.__tag = tag
+        self.__templatePid = None
+        self.__inlet.close()
+        self.__eventLog = LogEvents(self.__settings['eventMax'], self.__settings['eventBytes'])
+        (self.__outbox, self.__outboxBytes, self.__sent) = (list(), 0, time.time())
+
+    # logEvent method - generates a log entry
+    def logEvent(self, logLevel, event, *args, **kwargs):
+        """
+        formats and logs event at logLevel, returning the formatted event; args and kwargs, 
+        if any, are applied with event.format only if some sink logs logLevel; events no 
+        sink logs return None right away
+        """
+
+        # return right away if no sink logs this level
+        if int(logLevel) > self.__maxLevel: return None
+        if args or kwargs: event = event.format(*args, **kwargs)
+        if not isinstance(event, basestring):
+            try:
+                event = str(event)
+            except UnicodeEncodeError:
+                event = unicode(event)
+
+        # create (or, after a fork, recreate) log template prefix
+        if self.__templatePid != os.getpid():
+            self.__templatePid = os.getpid()
+            ID = '{0}[{1}]'.format(self.__ID, self.__tag) if self.__tag else self.__ID
+            self.__template = ' '.join(['', socket.gethostname(), str(self.__templatePid), 
+                                        ID, '('])
+
+        # apply template to event message, reusing the timestamp string within a second
+        now = time.time()
+        second = int(now)
+        if second != self.__second:
+            d_t = datetime.datetime
+            dt = d_t.utcfromtimestamp(second) if self.__settings['utc'] else \
+                d_t.fromtimestamp(second)
+            (self.__second, self.__stamp) = (second, dt.strftime('%Y-%m-%dT%H:%M:%S'))
+        event = ''.join([self.__stamp, '.%06d' % int((now - second) * 1000000), 
+                         self.__template, Log.levels.NAMES[logLevel], '): ', event])
+
+        # save event to internal log if meets logLevel requirement
+        if int(logLevel) <= int(self.__settings['logLevel']): 
+            self.__eventLog.append(logLevel, now, event)
+
+        # write event to stdout, logFiles, and amqp, or queue it for the writer thread, or
+        # in a forked child, send it to the parent's collector
+        if self.__outbox is not None: self.__post(logLevel, event, now)
+        elif self.__settings['logAsync']: self.__enqueue(logLevel, event, now)
+        else: self.__dispatch(logLevel, event, now)
 
         # return formatted event message
         return event
 
+    # events method - returns the internal event log
+    def events(self):
+        """returns the internal LogEvents event log for querying (see LogEvents.last, 
+           LogEvents.level, and LogEvents.since)"""
+
+        return self.__eventLog
+
+    # dropped method - returns the number of events dropped in async mode
+    def dropped(self):
+        """returns the number of events dropped because the async queue was full"""
+
+        return self.__dropped
+
+    # flush method - flushes buffered log file lines
+    def flush(self):
+        """flushes buffered lines to log files; in async mode, waits for the writer thread 
+           to write all queued events; in a forked child, sends the outbox to the 
+           collector"""
+
+        if self.__outbox is not None: 
+            self.__send()
+            for f in self.__sinks: f.flush()
+        elif self.__pid == os.getpid() and self.__writer.is_alive(): self.__queue.join()
+        else:
+            for f in self.__sinks: f.flush()
+
+    # close method - flushes and closes log files
+    def close(self):
+        """stops the collector and writer threads, if any, and flushes and closes log 
+           files"""
+
+        if self.__outbox is not None: self.__send()
+        elif self.__collector is not None and self.__collector.is_alive():
+            self.__outlet.send('')
+            self.__collector.join()
+            self.__inlet.close()
+        if self.__pid == os.getpid() and self.__writer.is_alive():
+            self.__queue.put(None)
+            self.__writer.join()
+        for f in self.__sinks: f.close()
+
+# logFlushAll - flushes all live logs
+def logFlushAll():
+    """stops the logTick thread and flushes every live Log object (registered with 
+       atexit)"""
+
+    logStopping.set()
+    if logFlusher is not None and logFlusher.is_alive(): logFlusher.join(1)
+    for log in list(logRegistry): log.flush()
+
+atexit.register(logFlushAll)
+
+# LogTimer - times a block or function into a LogMetrics histogram
+class LogTimer(object):
+    """times a with block, or each call of a decorated function, into histogram name"""
+
+    # constructor method - set metrics and histogram name
+    def __init__(self, metrics, name):
+        """set metrics and histogram name"""
+
+        self.metrics = metrics
+        self.name = name
+
+    # __enter__ method - starts timing a with block
+    def __enter__(self):
+        """starts timing a with block"""
+
+        self.start = time.time()
+        return self
+
+    # __exit__ method - records the with block's duration
+    def __exit__(self, eType, value, tb):
+        """records the with block's duration, even if it raised"""
+
+        self.metrics.observe(self.name, time.time() - self.start)
+
+    # __call__ method - decorates a function to time each call
+    def __call__(self, fn):
+        """returns fn wrapped to record the duration of each call"""
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.metrics.observe(self.name, time.time() - start)
+        timed.__name__ = fn.__name__
+        timed.__doc__ = fn.__doc__
+        return timed
+
+# LogMetrics - per-thread counters and latency histograms snapshotted to a Log
+class LogMetrics(object):
+    """
+    counters and fixed-bucket latency histograms kept per thread without locks and summed
+    on snapshot; emit() logs each metric's change since the last emit (count, sum, p50, 
+    p99, and max bucket bounds) as one event through the log's sinks, and with 
+    background=True a daemon thread emits every interval secs; bounds are the histogram 
+    buckets' upper bounds in secs (default 1us doubling to ~134 secs)
+    """
+
+    # constructor method - set log, interval, and buckets and start emitting, if background
+    def __init__(self, log, interval=60.0, logLevel=None, bounds=None, background=False):
+        """set log, emit interval and logLevel (default INFO), and bucket bounds and start
+           the background thread, if background"""
+
+        self.log = log
+        self.interval = interval
+        self.logLevel = Log.levels.INFO if logLevel is None else logLevel
+        self.bounds = list(bounds) if bounds else [0.000001 * 2 ** i for i in range(28)]
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.threads = list()  # each thread's (counters, histograms) dicts
+        self.lastCounters = dict()    # counter totals at the last emit
+        self.lastHistograms = dict()  # histogram totals at the last emit
+        self.running = background
+        if background:
+            self.thread = threading.Thread(target=self.poll)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # data method - returns this thread's counters and histograms
+    def data(self):
+        """returns this thread's (counters, histograms) dicts, creating them on first use;
+           histograms are lists of bucket counts (the last bucket is overflow) and the sum"""
+
+        try:
+            return self.local.data
+        except AttributeError:
+            data = self.local.data = (dict(), dict())
+            with self.lock: self.threads.append(data)
+            return data
+
+    # count method - adds to a counter
+    def count(self, name, n=1):
+        """adds n to counter name"""
+
+        counters = self.data()[0]
+        counters[name] = counters.get(name, 0) + n
+
+    # observe method - records a duration in a histogram
+    def observe(self, name, secs):
+        """records secs in histogram name"""
+
+        histograms = self.data()[1]
+        h = histograms.get(name)
+        if h is None: h = histograms[name] = [0] * (len(self.bounds) + 1) + [0.0]
+        h[bisect.bisect_left(self.bounds, secs)] += 1
+        h[-1] += secs
+
+    # timer method - returns a timer for a with block or decorator
+    def timer(self, name):
+        """returns a LogTimer recording into histogram name, e.g. with metrics.timer(n): 
+           or @metrics.timer(n)"""
+
+        return LogTimer(self, name)
+
+    # snapshot method - sums all threads' counters and histograms
+    def snapshot(self):
+        """returns (counters, histograms) dicts of totals across threads"""
+
+        (counters, histograms) = (dict(), dict())
+        with self.lock: threads = list(self.threads)
+        for (c, h) in threads:
+            for (name, n) in c.items(): counters[name] = counters.get(name, 0) + n
+            for (name, b) in h.items():
+                total = histograms.setdefault(name, [0] * len(b))
+                for i in range(len(b)): total[i] += b[i]
+        return (counters, histograms)
+
+    # percentile method - returns the bucket bound a percentile falls in
+    def percentile(self, buckets, p):
+        """returns the upper bound of the bucket holding percentile p (0-100) of the 
+           bucket counts, or None if they are empty (inf for the overflow bucket)"""
+
+        n = sum(buckets)
+        if not n: return None
+        (rank, seen) = (p / 100.0 * n, 0)
+        for i in range(len(buckets)):
+            seen += buckets[i]
+            if seen >= rank and seen: break
+        return self.bounds[i] if i < len(self.bounds) else float('inf')
+
+    # emit method - logs each metric's change since the last emit
+    def emit(self):
+        """logs the change in each counter and histogram since the last emit; returns the
+           events logged"""
+
+        (counters, histograms) = self.snapshot()
+        events = list()
+        for name in sorted(counters):
+            n = counters[name] - self.lastCounters.get(name, 0)
+            self.lastCounters[name] = counters[name]
+            if n: events.append(self.log.logEvent(self.logLevel, 
+                                                  'metric {0} count={1}', name, n))
+        for name in sorted(histograms):
+            h = histograms[name]
+            last = self.lastHistograms.get(name, [0] * len(h))
+            d = [h[i] - last[i] for i in range(len(h))]
+            self.lastHistograms[name] = h
+            buckets = d[:-1]
+            if not sum(buckets): continue
+            nonzero = [i for i in range(len(buckets)) if buckets[i]]
+            top = self.bounds[nonzero[-1]] if nonzero[-1] < len(self.bounds) else \
+                float('inf')
+            events.append(self.log.logEvent(
+                self.logLevel, 'metric {0} count={1} sum={2:.6f} p50={3:g} p99={4:g} '
+                'max={5:g}', name, sum(buckets), d[-1], self.percentile(buckets, 50), 
+                self.percentile(buckets, 99), top))
+        return events
+
+    # poll method - emits every interval secs until stopped
+    def poll(self):
+        """emits every interval secs until stop is called"""
+
+        while self.running:
+            time.sleep(self.interval)
+            try:
+                self.emit()
+            except Exception as e:
+                sys.stderr.write('LogMetrics: {0}{1}'.format(e, os.linesep))
+
+    # stop method - stops the background thread
+    def stop(self):
+        """stops the background thread"""
+
+        self.running = False
+
 ##############################################################################################
 # TESTING #
 ##############################################################################################
@@ -136,9 +1141,48 @@ def main():
         }
     log = Log('test', logAmqp=amqpTestConfig, logFile=[(Log.levels.DEBUG, 'test.log')])
     print 'Log...', log.logEvent(Log.levels.DEBUG, 'test log event')
+    log.close()
+    log = Log('test', logAmqp=dict(amqpTestConfig.items() + [('port', 5999)]), amqpRetry=0)
+    for i in range(10): log.logEvent(Log.levels.ERROR, 'test log event {0}', i)
+    print 'LogAmqp(down)...', 'survived 10 events'
+    log = Log('test', logFile=[(Log.levels.DEBUG, 'test.log')], fileRotateBytes=1024)
+    for i in range(100): log.logEvent(Log.levels.INFO, 'test log event {0}'.format(i))
+    log.close()
+    print 'LogFile...', os.path.getsize('test.log'), os.path.getsize('test.log.1')
+    log = Log('test', logFile=[(Log.levels.DEBUG, 'test.log')], logAsync=True, queueSize=10,
+              queuePolicy='dropOldest')
+    t = time.time()
+    for i in range(10000): log.logEvent(Log.levels.INFO, 'test log event {0}'.format(i))
+    t = time.time() - t
+    log.close()
+    print 'Log(logAsync)...', t / 10000, log.dropped()
+    log = Log('test', logLevel=Log.levels.INFO, logStdout=Log.levels.INFO)
+    t = time.time()
+    for i in range(10000): log.logEvent(Log.levels.DEBUG, 'test log event {0}', i)
+    t = time.time() - t
+    print 'Log(gated)...', t / 10000, log.logEvent(Log.levels.INFO, 'test {0} {x}', 1, x=2)
+    log = Log('test', eventMax=100)
+    for i in range(1000): log.logEvent(i % 5 + 1, 'test log event {0}', i)
+    print 'LogEvents...', len(log.events()), log.events().last(1), \
+        len(log.events().level(Log.levels.ERROR)), len(log.events().since(time.time() - 60))
+    log = Log('test', logBinary=[(Log.levels.DEBUG, 'test.blog')], binaryIndexEvery=100)
+    for i in range(1000): log.logEvent(i % 5 + 1, 'test log event {0}', i)
+    log.close()
+    reader = LogReader('test.blog')
+    t = time.time()
+    print 'LogReader...', len(list(reader.query(t - 60, t, Log.levels.ERROR)))
+    reader.close()
+    log = Log('test', logStdout=Log.levels.INFO)
+    metrics = LogMetrics(log)
+    @metrics.timer('test.sleep')
+    def sleepTest(secs): time.sleep(secs)
+    for i in range(10): sleepTest(0.001 * i)
+    with metrics.timer('test.block'): metrics.count('test.count', 5)
+    print 'LogMetrics...', len(metrics.emit()), metrics.emit()
 
 if __name__ == '__main__':
 
     try:
-        main()
+        if argParse(keySearch='export'): logExport()
+        else: main()
     except error as e: print e.error
@@ -97,10 +97,15 @@ class ProntabEvent(object):
 class Prontab(object):
     """cron-style scheduler class for python"""
 
-    def __init__(self, *events):
-        """init with one or more ProntabEvent objects"""
+    def __init__(self, *events, **settings):
+        """init with one or more ProntabEvent objects; with aggregate=True, children send 
+           their events' log entries to a collector in the parent (see Log.collect); with 
+           metrics=LogMetrics(...), each action's run time is recorded in a histogram 
+           named for the action"""
 
         self.events = list(events)
+        self.aggregate = settings.get('aggregate', False)
+        self.metrics = settings.get('metrics')
         # create child pid property in event object(s)
         for i in range(len(self.events)): self.events[i].pid = 0
 
@@ -109,6 +114,11 @@ class Prontab(object):
            action with args, storing child pid in event object; only calls action on
            events with non-active child pids"""
 
+        # start collecting events' log entries from children, if enabled
+        if self.aggregate:
+            for e in self.events:
+                if e.log and isinstance(e.log, Log): e.log.collect()
+
         while True:
 
             # step through each event
@@ -124,6 +134,8 @@ class Prontab(object):
                     e.pid = os.fork()
                     # child calls action with args and reports errors via stderr
                     if not e.pid:
+                        if self.aggregate and e.log and isinstance(e.log, Log):
+                            e.log.forked(e.action.__name__)
                         try:
                             e.action(*e.args, **e.kwargs)
                             sys.exit(0)
@@ -141,10 +153,12 @@ class Prontab(object):
                     if status != 0:
                         err = 'child (pid={0}) exited with status {1}'
                         raise error('Prontab', 'error', err.format(pid, status))
-                    # otherwise, if a log object was passed to the constructor, log action
-                    elif e.log and isinstance(e.log, Log):
-                        t = (datetime.datetime.utcnow() - e.__dt__)
-                        m = [e.action.__name__, t.seconds + t.microseconds / 1000000.0]
+                    # otherwise, record the run time, if metrics were passed to the 
+                    # constructor, and log action, if a log object was passed to the event
+                    t = (datetime.datetime.utcnow() - e.__dt__)
+                    m = [e.action.__name__, t.seconds + t.microseconds / 1000000.0]
+                    if self.metrics: self.metrics.observe(*m)
+                    if e.log and isinstance(e.log, Log):
                         e.log.logEvent(Log.levels.INFO, '{} completed in {} secs'.format(*m))
 
             time.sleep(wait)
@@ -156,7 +170,8 @@ class Prontab(object):
 def main():
 
     # prontab test
-    def prontabTask(i, *args):
+    def prontabTask(i, log=None):
+        if log: log.logEvent(Log.levels.INFO, 'prontab task {0}', i)
         if i: raise error('prontab', 'unit test -', 'test error')
     print aColor('BLUE') + 'prontab.run()...', aColor('OFF')
     try:
@@ -168,6 +183,17 @@ def main():
         p.run()
     except error as e: print aColor('BLUE') + ' ...Done(', e.error, ')', aColor('OFF')
 
+    # prontab aggregated log test
+    print aColor('BLUE') + 'prontab.run(aggregate=True)...', aColor('OFF')
+    try:
+        log = Log('test', logStdout=Log.levels.INFO)
+        p = Prontab(ProntabEvent(prontabTask, args=[0, log], log=log),
+                    ProntabEvent(prontabTask, args=[0, log], log=log),
+                    ProntabEvent(prontabTask, second=set(range(5)), minute=r'*/1',
+                                 args=[1, log], log=log), aggregate=True)
+        p.run()
+    except error as e: print aColor('BLUE') + ' ...Done(', e.error, ')', aColor('OFF')
+
 if __name__ == '__main__':
 
     try: